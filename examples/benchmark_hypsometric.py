@@ -0,0 +1,33 @@
+# noqa
+# coding=utf-8
+from __future__ import division, print_function
+
+import timeit
+
+import numpy as np
+
+from tilezen.transformations.normal import (_height_mapping,
+                                            _height_mapping_func)
+
+# 256px and 512px (@2x) tiles, plus Normal's 4px buffer
+TILE_SIZES = [256, 264, 512, 520]
+REPEAT = 3
+
+if __name__ == "__main__":
+    vectorized = np.vectorize(_height_mapping_func)
+
+    for size in TILE_SIZES:
+        data = np.random.uniform(-11000.0, 9000.0, (size, size)).astype(
+            np.float32)
+
+        assert np.array_equal(
+            vectorized(data).astype(np.uint8), _height_mapping(data))
+
+        before = min(
+            timeit.repeat(lambda: vectorized(data), number=1, repeat=REPEAT))
+        after = min(
+            timeit.repeat(
+                lambda: _height_mapping(data), number=10, repeat=REPEAT)) / 10
+
+        print("{0}x{0}: np.vectorize {1:0.4f}s, searchsorted {2:0.5f}s "
+              "({3:0.0f}x)".format(size, before, after, before / after))
@@ -0,0 +1,47 @@
+# noqa
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import logging
+
+from marblecutter.stats import Timer
+from tilezen.catalogs import PostGISFootprints, TileIndexCatalog
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('batchtiler')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build (or refresh part of) a materialized tile -> "
+        "sources index from a PostGIS footprints table.")
+    parser.add_argument('table', help="e.g. footprints or dems")
+    parser.add_argument('path', help="SQLite file to write the index to")
+    parser.add_argument(
+        '--bounds',
+        type=float,
+        nargs=4,
+        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+        default=(-180, -85.0511, 180, 85.0511),
+        help="Only refresh tiles intersecting these bounds, e.g. those of "
+        "footprints that changed")
+    parser.add_argument('--min-zoom', type=int, default=0)
+    parser.add_argument(
+        '--max-zoom',
+        type=int,
+        default=12,
+        help="Deepest zoom to index (fixed when the index is created)")
+    args = parser.parse_args()
+
+    index = TileIndexCatalog.create(args.path, max_zoom=args.max_zoom)
+
+    with Timer() as t:
+        count = index.refresh(
+            PostGISFootprints(table=args.table),
+            bounds=tuple(args.bounds),
+            min_zoom=args.min_zoom,
+            max_zoom=min(args.max_zoom, index.max_zoom))
+
+    logger.info("Indexed %d tiles from %s in %0.2fs", count, args.table,
+                t.elapsed)
@@ -0,0 +1,41 @@
+# noqa
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import logging
+
+from marblecutter.stats import Timer
+from tilezen.catalogs import (PostGISFootprints, SnapshotCatalog,
+                              SpatialiteCatalog)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('batchtiler')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a footprint catalog to a snapshot file that "
+        "SnapshotCatalog can query without a database.")
+    parser.add_argument('path', help="Snapshot file to write")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        '--table', help="PostGIS table to export (e.g. footprints or dems)")
+    source.add_argument(
+        '--spatialite', help="SpatialiteCatalog snapshot to export")
+    parser.add_argument('--node-size', type=int, default=16)
+    args = parser.parse_args()
+
+    with Timer() as t:
+        if args.table:
+            # all enabled footprints, used at any zoom
+            footprints = PostGISFootprints(table=args.table)(
+                (-180, -90, 180, 90), 0, 30)
+        else:
+            footprints = SpatialiteCatalog.load(args.spatialite).footprints()
+
+        count = SnapshotCatalog.write(
+            args.path, footprints, node_size=args.node_size)
+
+    logger.info("Wrote %d footprints to %s in %0.2fs", count, args.path,
+                t.elapsed)
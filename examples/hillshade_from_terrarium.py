@@ -0,0 +1,32 @@
+# coding=utf-8
+from __future__ import print_function
+
+import logging
+import sys
+
+from mercantile import Tile
+
+from marblecutter import tiling
+from marblecutter.formats.color_ramp import ColorRamp
+from tilezen.catalogs import TileCatalog
+from tilezen.transformations import Hillshade
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    # e.g. terrarium/{z}/{x}/{y}.png or terrarium.mbtiles
+    catalog = TileCatalog(sys.argv[1], encoding="terrarium", max_zoom=15)
+
+    tile = Tile(1308, 3164, 13)
+    (headers, data) = tiling.render_tile(
+        tile,
+        catalog,
+        format=ColorRamp(),
+        transformation=Hillshade(resample=True, add_slopeshade=True),
+        scale=2)
+
+    print("Headers: ", headers)
+
+    with open("tmp/{}_{}_{}_hillshade.png".format(tile.z, tile.x, tile.y),
+              "w") as f:
+        f.write(data)
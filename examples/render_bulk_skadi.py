@@ -9,9 +9,10 @@ import time
 from functools import wraps
 from multiprocessing.dummy import Pool
 
-from marblecutter import skadi
 from marblecutter.sources import PostGISAdapter
 from marblecutter.stats import Timer
+from tilezen import skadi
+from tilezen.formats import Skadi
 
 logging.basicConfig(level=logging.INFO)
 # Quieting boto messages down a little
@@ -87,9 +88,9 @@ def write_to_s3(bucket, key,
     return obj
 
 
-def render_tile_and_put_to_s3(tile, s3_bucket, key_prefix):
+def render_tile_and_put_to_s3(tile, s3_bucket, key_prefix, format):
     with Timer() as t:
-        (headers, data) = skadi.render_tile(tile, CATALOG)
+        (headers, data) = skadi.render_tile(tile, CATALOG, format=format)
     logger.info("Skadi tile %s rendered in %0.3f",
                 tile, t.elapsed)
 
@@ -111,16 +112,17 @@ def render_tile_and_put_to_s3(tile, s3_bucket, key_prefix):
                 tile, obj.bucket_name, obj.key, t.elapsed)
 
 
-def render_tile_exc_wrapper(tile, s3_bucket, key_prefix):
+def render_tile_exc_wrapper(tile, s3_bucket, key_prefix, format):
     try:
-        render_tile_and_put_to_s3(tile, s3_bucket, key_prefix)
+        render_tile_and_put_to_s3(tile, s3_bucket, key_prefix, format)
     except Exception:
         logger.exception('Error while processing tile %s', tile)
         raise
 
 
-def queue_tile(tile, bucket, key_prefix):
-    POOL.apply_async(render_tile_exc_wrapper, args=[tile, bucket, key_prefix])
+def queue_tile(tile, bucket, key_prefix, format):
+    POOL.apply_async(
+        render_tile_exc_wrapper, args=[tile, bucket, key_prefix, format])
 
 
 if __name__ == "__main__":
@@ -128,13 +130,26 @@ if __name__ == "__main__":
     parser.add_argument('bucket')
     parser.add_argument('tiles', nargs='+')
     parser.add_argument('--prefix')
+    parser.add_argument(
+        '--compression-threads',
+        type=int,
+        default=4,
+        help='Threads used to gzip each tile')
+    parser.add_argument(
+        '--compression-level',
+        type=int,
+        default=9,
+        help='gzip compression level (1-9)')
     args = parser.parse_args()
 
+    format = Skadi(compresslevel=args.compression_level,
+                   threads=args.compression_threads)
+
     logger.info("Writing %s Skadi tiles to S3 bucket %s with prefix '%s'",
                 len(args.tiles), args.bucket, args.prefix)
 
     for tile in args.tiles:
-        queue_tile(tile, args.bucket, args.prefix)
+        queue_tile(tile, args.bucket, args.prefix, format)
 
     POOL.close()
     POOL.join()
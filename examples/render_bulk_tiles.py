@@ -7,7 +7,6 @@ import botocore
 import logging
 import mercantile
 import os
-import psycopg2
 import psycopg2.extras
 import re
 import time
@@ -18,11 +17,13 @@ from shapely.geometry import box
 from urlparse import urlparse
 
 from marblecutter import tiling
-from marblecutter.formats import PNG, GeoTIFF
+from marblecutter.formats import PNG
 from marblecutter.sources import MemoryAdapter
 from marblecutter.stats import Timer
 from marblecutter.transformations import Normal, Terrarium
 from mercantile import Tile
+from tilezen.formats import geotiff
+from tilezen.postgis import get_pool
 
 logging.basicConfig(level=logging.INFO)
 # Quieting boto messages down a little
@@ -35,7 +36,7 @@ logger = logging.getLogger('batchtiler')
 
 POOL = Pool(12)
 
-GEOTIFF_FORMAT = GeoTIFF()
+GEOTIFF_FORMAT = geotiff.from_env()
 PNG_FORMAT = PNG()
 NORMAL_TRANSFORMATION = Normal()
 TERRARIUM_TRANSFORMATION = Terrarium()
@@ -206,7 +207,7 @@ def build_source(bbox):
 
     database_url = os.environ.get('DATABASE_URL')
 
-    with psycopg2.connect(database_url) as conn:
+    with get_pool(database_url).connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
             cur.execute("""
                 SELECT
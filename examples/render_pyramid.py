@@ -8,7 +8,7 @@ import logging
 import os
 import random
 import time
-from functools import wraps
+from functools import partial, wraps
 from multiprocessing.dummy import Pool
 
 from shapely import wkb
@@ -17,15 +17,21 @@ from shapely.geometry import box
 import boto3
 import botocore
 import mercantile
-import psycopg2
 import psycopg2.extras
 import threading
-from marblecutter import tiling
-from marblecutter.formats import PNG, GeoTIFF
+from marblecutter import NoDataAvailable
+from marblecutter.formats import PNG
 from marblecutter.sources import MemoryAdapter
 from marblecutter.stats import Timer
-from marblecutter.transformations import Normal, Terrarium
 from mercantile import Tile
+from rasterio.warp import Resampling
+from tilezen.formats import geotiff
+from tilezen.postgis import get_pool
+from tilezen.tiling import (CONSTANT_HEADER, encode_outputs, merge_children,
+                            mosaic_buffer, mosaic_groups, mosaic_sources,
+                            render_metatile, render_mosaic,
+                            render_tile_outputs)
+from tilezen.transformations import Normal, Terrarium
 
 logging.basicConfig(level=logging.INFO)
 # Quieting boto messages down a little
@@ -55,8 +61,10 @@ OVERWRITE = os.environ.get('OVERWRITE_EXISTING_OBJECTS') == 'true'
 # Only render these tile types
 ONLY_RENDER = os.environ.get('ONLY_RENDER').split(',') \
               if os.environ.get('ONLY_RENDER') else None
+# Write (transparent / nodata) placeholders for tiles without data
+WRITE_EMPTY_TILES = os.environ.get('WRITE_EMPTY_TILES') == 'true'
 
-GEOTIFF_FORMAT = GeoTIFF()
+GEOTIFF_FORMAT = geotiff.from_env()
 PNG_FORMAT = PNG()
 NORMAL_TRANSFORMATION = Normal()
 TERRARIUM_TRANSFORMATION = Terrarium()
@@ -67,6 +75,13 @@ RENDER_COMBINATIONS = [
     ("geotiff", None, GEOTIFF_FORMAT, ".tif", 2),
 ]
 
+# bottom-up pyramids keep one mosaic per tile that can produce every output
+MOSAIC_SCALE = max(scale for (_, _, _, _, scale) in RENDER_COMBINATIONS)
+MOSAIC_BUFFER = mosaic_buffer(
+    [(transformation, format, scale)
+     for (_, transformation, format, _, scale) in RENDER_COMBINATIONS],
+    MOSAIC_SCALE)
+
 
 def s3_key(key_prefix, tile_type, tile, key_suffix):
     key = '{}/{}/{}/{}{}'.format(
@@ -125,13 +140,16 @@ def write_to_s3(obj,
                 raise
 
 
-def build_source_index(tile, min_zoom, max_zoom):
+def build_source_index(tile, min_zoom, max_zoom, margin=0):
     source_cache = MemoryAdapter()
-    bbox = box(*mercantile.bounds(tile))
+    # margin is a fraction of the tile's size
+    (west, south, east, north) = mercantile.bounds(tile)
+    (dx, dy) = ((east - west) * margin, (north - south) * margin)
+    bbox = box(west - dx, max(south - dy, -90), east + dx, min(north + dy, 90))
 
     database_url = os.environ.get('DATABASE_URL')
 
-    with psycopg2.connect(database_url) as conn:
+    with get_pool(database_url).connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
             cur.execute("""
                 SELECT
@@ -189,9 +207,10 @@ def s3_obj_exists(obj):
                 wait += random.uniform(0.0, wait / 2.0)
 
 
-def render_tile_and_put_to_s3(tile, s3_details, sources):
+def pending_combinations(tile, s3_details):
     s3_bucket, s3_key_prefix = s3_details
 
+    combinations = []
     for (type, transformation, format, ext, scale) in RENDER_COMBINATIONS:
         if ONLY_RENDER and type not in ONLY_RENDER:
             logger.debug(
@@ -211,16 +230,25 @@ def render_tile_and_put_to_s3(tile, s3_details, sources):
             )
             continue
 
-        with Timer() as t:
-            (headers, data) = tiling.render_tile(
-                tile, sources,
-                format=format,
-                transformation=transformation,
-                scale=scale)
+        combinations.append((type, transformation, format, ext, scale, obj))
+
+    return combinations
+
+
+def put_outputs_to_s3(tile, combinations, outputs):
+    for ((type, _, _, ext, _, obj), (headers, data)) in zip(
+            combinations, outputs):
+        if (headers.get(CONSTANT_HEADER) == 'masked'
+                and not WRITE_EMPTY_TILES):
+            logger.debug(
+                '(%02d/%06d/%06d) Skipping empty %s tile',
+                tile.z, tile.x, tile.y, type,
+            )
+            continue
 
         logger.debug(
-            '(%02d/%06d/%06d) Took %0.3fs to render %s tile (%s bytes), Source: %s, Timers: %s',
-            tile.z, tile.x, tile.y, t.elapsed, type,
+            '(%02d/%06d/%06d) Rendered %s tile (%s bytes), Source: %s, Timers: %s',
+            tile.z, tile.x, tile.y, type,
             len(data),
             headers.get('X-Imagery-Sources'),
             headers.get('X-Timers'),
@@ -236,6 +264,263 @@ def render_tile_and_put_to_s3(tile, s3_details, sources):
         )
 
 
+def render_tile_and_put_to_s3(tile, s3_details, sources):
+    combinations = pending_combinations(tile, s3_details)
+
+    if not combinations:
+        return
+
+    # read and mosaic sources once for all outputs
+    with Timer() as t:
+        outputs = render_tile_outputs(
+            tile, sources,
+            [(transformation, format, scale)
+             for (_, transformation, format, _, scale, _) in combinations])
+
+    logger.debug(
+        '(%02d/%06d/%06d) Took %0.3fs to render %s tiles',
+        tile.z, tile.x, tile.y, t.elapsed,
+        ', '.join(type for (type, _, _, _, _, _) in combinations),
+    )
+
+    put_outputs_to_s3(tile, combinations, outputs)
+
+
+def render_metatile_and_put_to_s3(meta, size, s3_details, sources):
+    levels = size.bit_length() - 1
+    tiles = descendants(meta, meta.z + levels)
+    pending = {tile: pending_combinations(tile, s3_details) for tile in tiles}
+
+    # render every type that's needed by at least one tile in the metatile
+    types = set(type for combinations in pending.values()
+                for (type, _, _, _, _, _) in combinations)
+    combinations = [
+        c for c in RENDER_COMBINATIONS if c[0] in types
+    ]
+
+    if not combinations:
+        return
+
+    with Timer() as t:
+        results = render_metatile(
+            meta, sources,
+            [(transformation, format, scale)
+             for (_, transformation, format, _, scale) in combinations],
+            size)
+
+    logger.debug(
+        '(%02d/%06d/%06d) Took %0.3fs to render %sx%s metatile',
+        meta.z, meta.x, meta.y, t.elapsed, size, size,
+    )
+
+    for (tile, outputs) in results:
+        outputs = dict(zip([type for (type, _, _, _, _) in combinations],
+                           outputs))
+
+        put_outputs_to_s3(tile, pending[tile],
+                          [outputs[type]
+                           for (type, _, _, _, _, _) in pending[tile]])
+
+
+def render_metatile_exc_wrapper(meta, size, s3_details, sources):
+    try:
+        render_metatile_and_put_to_s3(meta, size, s3_details, sources)
+    except Exception:
+        logger.exception('Error while processing metatile %s', meta)
+        raise
+
+
+def mosaic_from_sources(tile, sources):
+    try:
+        with Timer() as t:
+            (headers, pixels) = render_mosaic(tile, sources, MOSAIC_SCALE,
+                                              MOSAIC_BUFFER)
+    except NoDataAvailable:
+        logger.debug('(%02d/%06d/%06d) No data available',
+                     tile.z, tile.x, tile.y)
+        return {}, None
+
+    logger.debug(
+        '(%02d/%06d/%06d) Took %0.3fs to mosaic sources',
+        tile.z, tile.x, tile.y, t.elapsed,
+    )
+
+    return headers, pixels
+
+
+def sources_change_below(tile, sources):
+    """
+    Whether a tile's mosaic uses different sources than its children's would
+    (e.g. sources whose max_zoom is the tile's zoom), in which case it can't
+    be downsampled from them.
+    """
+    return (mosaic_sources(tile, sources, MOSAIC_SCALE, MOSAIC_BUFFER) !=
+            mosaic_sources(tile, sources, 2 * MOSAIC_SCALE,
+                           2 * MOSAIC_BUFFER))
+
+
+def build_tile(tile, neighborhood, s3_details, sources, resampling):
+    """
+    Build a tile's mosaic and write its outputs. `neighborhood` holds the
+    (headers, mosaic) of the tile's children and their neighbors; the tile is
+    mosaicked from sources when it's None (at max_zoom) or when sources
+    change between the tile's zoom and its children's. Returns the tile's
+    (headers, mosaic); the mosaic is None when there's no data.
+    """
+    if neighborhood is None or sources_change_below(tile, sources):
+        (headers, pixels) = mosaic_from_sources(tile, sources)
+    else:
+        sources_used = set()
+
+        for child in mercantile.children(tile):
+            child_headers = neighborhood.get(child, ({}, None))[0]
+
+            if child_headers.get('X-Imagery-Sources'):
+                sources_used.update(
+                    child_headers['X-Imagery-Sources'].split(', '))
+
+        pixels = merge_children(
+            tile,
+            {child: pixels
+             for child, (_, pixels) in neighborhood.items()},
+            MOSAIC_BUFFER,
+            resampling=resampling)
+        headers = {'X-Imagery-Sources': ', '.join(sorted(sources_used))}
+
+    if pixels is None:
+        return headers, None
+
+    combinations = pending_combinations(tile, s3_details)
+
+    if combinations:
+        outputs = [(transformation, format, scale)
+                   for (_, transformation, format, _, scale, _)
+                   in combinations]
+        results = [None] * len(outputs)
+
+        with Timer() as t:
+            groups = mosaic_groups(tile, sources, outputs, MOSAIC_SCALE,
+                                   MOSAIC_BUFFER)
+
+            for (index, result) in zip(groups[0], encode_outputs(
+                    pixels, MOSAIC_BUFFER, [outputs[i] for i in groups[0]],
+                    MOSAIC_SCALE, headers=headers)):
+                results[index] = result
+
+            # outputs whose scales select other sources are rendered directly
+            for indexes in groups[1:]:
+                for (index, result) in zip(indexes, render_tile_outputs(
+                        tile, sources, [outputs[i] for i in indexes])):
+                    results[index] = result
+
+        logger.debug(
+            '(%02d/%06d/%06d) Took %0.3fs to encode %s tiles',
+            tile.z, tile.x, tile.y, t.elapsed,
+            ', '.join(type for (type, _, _, _, _, _) in combinations),
+        )
+
+        put_outputs_to_s3(tile, combinations, results)
+
+    return headers, pixels
+
+
+def build_tile_exc_wrapper(job, s3_details, sources, resampling):
+    (tile, neighborhood, inside) = job
+
+    try:
+        if not inside:
+            # a neighbor of the pyramid, only used for its buffer
+            return mosaic_from_sources(tile, sources)
+
+        return build_tile(tile, neighborhood, s3_details, sources,
+                          resampling)
+    except Exception:
+        logger.exception('Error while processing tile %s', tile)
+        raise
+
+
+def build_pyramid_rows(root, zoom, max_zoom, s3_details, sources,
+                       resampling):
+    """
+    Build the tiles at `zoom` beneath `root` bottom-up (see `build_tile`),
+    yielding a row at a time, top to bottom, as a dict of tile -> (headers,
+    mosaic). Below the root, rows include a ring of neighboring tiles
+    (mosaicked from sources but not written) that fill the buffers of tiles
+    at the pyramid's edges. Only the 4 rows of children that a row of parents
+    needs are held at a time.
+    """
+    size = 2**(zoom - root.z)
+    (x0, y0) = (root.x * size, root.y * size)
+    ring = 1 if zoom > root.z else 0
+    xs = range(max(x0 - ring, 0), min(x0 + size + ring, 2**zoom))
+    ys = range(max(y0 - ring, 0), min(y0 + size + ring, 2**zoom))
+
+    if zoom < max_zoom:
+        child_rows = build_pyramid_rows(root, zoom + 1, max_zoom, s3_details,
+                                        sources, resampling)
+        children = {}
+        last_row = None
+
+    for y in ys:
+        tiles = [Tile(x, y, zoom) for x in xs]
+        neighborhoods = [None] * len(tiles)
+
+        if zoom < max_zoom:
+            # parents in this row need children from rows 2y - 1 to 2y + 2
+            while last_row is None or last_row < 2 * y + 2:
+                row = next(child_rows, None)
+
+                if row is None:
+                    break
+
+                children.update(row)
+                last_row = next(iter(row)).y
+
+            for child in [c for c in children if c.y < 2 * y - 1]:
+                del children[child]
+
+            neighborhoods = [{
+                child: children[child]
+                for child in (Tile(2 * tile.x + dx, 2 * tile.y + dy, zoom + 1)
+                              for dx in range(-1, 3) for dy in range(-1, 3))
+                if child in children
+            } for tile in tiles]
+
+        inside = [
+            x0 <= tile.x < x0 + size and y0 <= tile.y < y0 + size
+            for tile in tiles
+        ]
+
+        results = POOL.map(
+            partial(
+                build_tile_exc_wrapper,
+                s3_details=s3_details,
+                sources=sources,
+                resampling=resampling), zip(tiles, neighborhoods, inside))
+
+        yield dict(zip(tiles, results))
+
+
+def render_pyramid_bottom_up(root, max_zoom, s3_details, sources,
+                             resampling):
+    # each row of tiles is built in parallel once the rows of children it
+    # needs are available
+    for _ in build_pyramid_rows(root, root.z, max_zoom, s3_details, sources,
+                                resampling):
+        pass
+
+
+def descendants(tile, zoom):
+    if tile.z == zoom:
+        return [tile]
+
+    return [
+        descendant
+        for child in mercantile.children(tile)
+        for descendant in descendants(child, zoom)
+    ]
+
+
 def queue_tile(tile, max_zoom, s3_details, sources):
     queue_render(tile, s3_details, sources)
 
@@ -249,6 +534,28 @@ def queue_render(tile, s3_details, sources):
     POOL.apply_async(render_tile_exc_wrapper, args=[tile, s3_details, sources])
 
 
+def queue_metatiles(root, max_zoom, size, s3_details, sources):
+    for zoom in range(root.z, max_zoom + 1):
+        # metatiles can't be larger than the root tile
+        levels = min(size.bit_length() - 1, zoom - root.z)
+
+        for meta in descendants(root, zoom - levels):
+            logger.debug('Enqueueing render for metatile %s', meta)
+            POOL.apply_async(
+                render_metatile_exc_wrapper,
+                args=[meta, 2**levels, s3_details, sources])
+
+
+def power_of_2(value):
+    size = int(value)
+
+    if size < 1 or size & (size - 1):
+        raise argparse.ArgumentTypeError(
+            '{} is not a power of 2'.format(value))
+
+    return size
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('x', type=int)
@@ -257,6 +564,20 @@ if __name__ == "__main__":
     parser.add_argument('max_zoom', type=int)
     parser.add_argument('bucket')
     parser.add_argument('--key_prefix')
+    parser.add_argument(
+        '--bottom_up',
+        action='store_true',
+        help='Only read sources at max_zoom and downsample the rest')
+    parser.add_argument(
+        '--downsample',
+        choices=['average', 'nearest'],
+        default='average',
+        help='How to downsample children when building bottom-up')
+    parser.add_argument(
+        '--metatile',
+        type=power_of_2,
+        default=1,
+        help='Render NxN blocks of tiles at once (N must be a power of 2)')
 
     args = parser.parse_args()
     root = Tile(args.x, args.y, args.zoom)
@@ -264,12 +585,24 @@ if __name__ == "__main__":
     logger.info('Caching sources for root tile %s to zoom %s',
                 root, args.max_zoom)
 
-    source_index = build_source_index(root, args.zoom, args.max_zoom)
+    # bottom-up pyramids also mosaic a ring of neighboring tiles (at most
+    # half the root's size beyond it) for the buffers of tiles at the edges
+    source_index = build_source_index(root, args.zoom, args.max_zoom,
+                                      margin=0.5 if args.bottom_up else 0)
 
     logger.info('Running %s processes', POOL_SIZE)
 
-    queue_tile(root, args.max_zoom, (args.bucket, args.key_prefix),
-               source_index)
+    if args.bottom_up:
+        render_pyramid_bottom_up(root, args.max_zoom,
+                                 (args.bucket, args.key_prefix),
+                                 source_index,
+                                 Resampling[args.downsample])
+    elif args.metatile > 1:
+        queue_metatiles(root, args.max_zoom, args.metatile,
+                        (args.bucket, args.key_prefix), source_index)
+    else:
+        queue_tile(root, args.max_zoom, (args.bucket, args.key_prefix),
+                   source_index)
 
     POOL.close()
     POOL.join()
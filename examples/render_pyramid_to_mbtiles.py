@@ -3,6 +3,7 @@
 from __future__ import print_function
 
 import argparse
+import hashlib
 import logging
 import os
 import random
@@ -16,15 +17,17 @@ from shapely.geometry import box
 import boto3
 import botocore
 import mercantile
-import psycopg2
 import psycopg2.extras
 import sqlite3
-from marblecutter import tiling
-from marblecutter.formats import PNG, GeoTIFF
+from marblecutter.formats import PNG
 from marblecutter.sources import MemoryAdapter
 from marblecutter.stats import Timer
-from marblecutter.transformations import Normal, Terrarium
 from mercantile import Tile
+from tilezen.formats import geotiff
+from tilezen.postgis import get_pool
+from tilezen.tiling import (CONSTANT_HEADER, render_metatile,
+                            render_tile_outputs)
+from tilezen.transformations import Normal, Terrarium
 
 logging.basicConfig(level=logging.INFO)
 # Quieting boto messages down a little
@@ -42,8 +45,10 @@ POOL_SIZE = 12
 POOL = Pool(POOL_SIZE)
 MBTILES_POOL = Pool(1)
 OVERWRITE = os.environ.get('OVERWRITE_EXISTING_OBJECTS') == 'true'
+# Write (transparent / nodata) placeholders for tiles without data
+WRITE_EMPTY_TILES = os.environ.get('WRITE_EMPTY_TILES') == 'true'
 
-GEOTIFF_FORMAT = GeoTIFF()
+GEOTIFF_FORMAT = geotiff.from_env()
 PNG_FORMAT = PNG()
 NORMAL_TRANSFORMATION = Normal()
 TERRARIUM_TRANSFORMATION = Terrarium()
@@ -87,16 +92,39 @@ def retry(ExceptionToCheck,
 
 
 class MbtilesOutput(object):
+    """
+    Writes deduplicated MBTiles: each distinct tile is stored once in
+    `images`, keyed by a hash of its contents, and `map` points tile
+    coordinates at them. A `tiles` view provides the standard schema.
+    """
+
     def __init__(self, filename, **kwargs):
         self._filename = filename
+        # hashes of tiles already written during this run
+        self._tile_ids = set()
 
     def _setup_mbtiles(self, cur):
         cur.execute("""
-            CREATE TABLE tiles (
+            CREATE TABLE map (
             zoom_level integer,
             tile_column integer,
             tile_row integer,
-            tile_data blob);
+            tile_id text);
+            """)
+        cur.execute("""
+            CREATE TABLE images (
+            tile_data blob,
+            tile_id text);
+            """)
+        cur.execute("""
+            CREATE VIEW tiles AS
+            SELECT
+                map.zoom_level AS zoom_level,
+                map.tile_column AS tile_column,
+                map.tile_row AS tile_row,
+                images.tile_data AS tile_data
+            FROM map
+            JOIN images ON images.tile_id = map.tile_id;
             """)
         cur.execute("""
             CREATE TABLE metadata
@@ -121,9 +149,12 @@ class MbtilesOutput(object):
             CREATE UNIQUE INDEX name ON metadata (name);
             """)
         cur.execute("""
-            CREATE UNIQUE INDEX tile_index ON tiles (
+            CREATE UNIQUE INDEX map_index ON map (
             zoom_level, tile_column, tile_row);
             """)
+        cur.execute("""
+            CREATE UNIQUE INDEX images_id ON images (tile_id);
+            """)
 
     def _optimize_connection(self, cur):
         cur.execute("""
@@ -169,9 +200,26 @@ class MbtilesOutput(object):
         self._setup_mbtiles(self._cur)
 
     def add_tile(self, tile, data):
+        tile_id = hashlib.sha1(data).hexdigest()
+
+        if tile_id not in self._tile_ids:
+            self._cur.execute("""
+                INSERT INTO images (
+                    tile_data, tile_id
+                ) VALUES (
+                    ?, ?
+                );
+                """,
+                (
+                    sqlite3.Binary(data),
+                    tile_id,
+                )
+            )
+            self._tile_ids.add(tile_id)
+
         self._cur.execute("""
-            INSERT INTO tiles (
-                zoom_level, tile_column, tile_row, tile_data
+            INSERT INTO map (
+                zoom_level, tile_column, tile_row, tile_id
             ) VALUES (
                 ?, ?, ?, ?
             );
@@ -180,7 +228,7 @@ class MbtilesOutput(object):
                 tile.z,
                 tile.x,
                 self._flip_y(tile.z, tile.y),
-                sqlite3.Binary(data),
+                tile_id,
             )
         )
 
@@ -195,7 +243,7 @@ def build_source_index(tile, min_zoom, max_zoom):
 
     database_url = os.environ.get('DATABASE_URL')
 
-    with psycopg2.connect(database_url) as conn:
+    with get_pool(database_url).connection() as conn:
         with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
             cur.execute("""
                 SELECT
@@ -237,24 +285,72 @@ def render_tile_exc_wrapper(tile, sources, output):
 
 
 def render_tile(tile, sources, output):
-    for (type, transformation, format, ext) in RENDER_COMBINATIONS:
-
-        with Timer() as t:
-            (headers, data) = tiling.render_tile(
-                tile, sources, format=format, transformation=transformation)
-
+    # read and mosaic sources once for all outputs
+    with Timer() as t:
+        outputs = render_tile_outputs(
+            tile, sources,
+            [(transformation, format, 1)
+             for (_, transformation, format, _) in RENDER_COMBINATIONS])
+
+    logger.debug(
+        '(%02d/%06d/%06d) Took %0.3fs to render %s tiles',
+        tile.z, tile.x, tile.y, t.elapsed,
+        ', '.join(type for (type, _, _, _) in RENDER_COMBINATIONS),
+    )
+
+    for ((type, _, _, _), (headers, data)) in zip(RENDER_COMBINATIONS,
+                                                  outputs):
         logger.debug(
-            '(%02d/%06d/%06d) Took %0.3fs to render %s tile (%s bytes), Source: %s, Timers: %s',
-            tile.z, tile.x, tile.y, t.elapsed, type,
+            '(%02d/%06d/%06d) Rendered %s tile (%s bytes), Source: %s, Timers: %s',
+            tile.z, tile.x, tile.y, type,
             len(data),
             headers.get('X-Imagery-Sources'),
             headers.get('X-Timers'),
         )
 
-        MBTILES_POOL.apply_async(
-            write_to_mbtiles,
-            args=[type, tile, headers, data, output]
+        queue_write(type, tile, headers, data, output)
+
+
+def render_metatile_exc_wrapper(meta, size, sources, output):
+    try:
+        render_metatile_tiles(meta, size, sources, output)
+    except Exception:
+        logger.exception('Error while processing metatile %s', meta)
+        raise
+
+
+def render_metatile_tiles(meta, size, sources, output):
+    # read and mosaic sources once for all tiles and outputs
+    with Timer() as t:
+        results = render_metatile(
+            meta, sources,
+            [(transformation, format, 1)
+             for (_, transformation, format, _) in RENDER_COMBINATIONS],
+            size)
+
+    logger.debug(
+        '(%02d/%06d/%06d) Took %0.3fs to render %sx%s metatile',
+        meta.z, meta.x, meta.y, t.elapsed, size, size,
+    )
+
+    for (tile, outputs) in results:
+        for ((type, _, _, _), (headers, data)) in zip(RENDER_COMBINATIONS,
+                                                      outputs):
+            queue_write(type, tile, headers, data, output)
+
+
+def queue_write(type, tile, headers, data, output):
+    if headers.get(CONSTANT_HEADER) == 'masked' and not WRITE_EMPTY_TILES:
+        logger.debug(
+            '(%02d/%06d/%06d) Skipping empty %s tile',
+            tile.z, tile.x, tile.y, type,
         )
+        return
+
+    MBTILES_POOL.apply_async(
+        write_to_mbtiles,
+        args=[type, tile, headers, data, output]
+    )
 
 
 def write_to_mbtiles(type, tile, headers, data, output):
@@ -285,6 +381,39 @@ def queue_render(tile, sources, output):
     POOL.apply_async(render_tile_exc_wrapper, args=[tile, sources, output])
 
 
+def descendants(tile, zoom):
+    if tile.z == zoom:
+        return [tile]
+
+    return [
+        descendant
+        for child in mercantile.children(tile)
+        for descendant in descendants(child, zoom)
+    ]
+
+
+def queue_metatiles(root, max_zoom, size, sources, output):
+    for zoom in range(root.z, max_zoom + 1):
+        # metatiles can't be larger than the root tile
+        levels = min(size.bit_length() - 1, zoom - root.z)
+
+        for meta in descendants(root, zoom - levels):
+            logger.debug('Enqueueing render for metatile %s', meta)
+            POOL.apply_async(
+                render_metatile_exc_wrapper,
+                args=[meta, 2**levels, sources, output])
+
+
+def power_of_2(value):
+    size = int(value)
+
+    if size < 1 or size & (size - 1):
+        raise argparse.ArgumentTypeError(
+            '{} is not a power of 2'.format(value))
+
+    return size
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('x', type=int)
@@ -292,6 +421,11 @@ if __name__ == "__main__":
     parser.add_argument('zoom', type=int)
     parser.add_argument('max_zoom', type=int)
     parser.add_argument('mbtiles_prefix')
+    parser.add_argument(
+        '--metatile',
+        type=power_of_2,
+        default=1,
+        help='Render NxN blocks of tiles at once (N must be a power of 2)')
 
     args = parser.parse_args()
     root = Tile(args.x, args.y, args.zoom)
@@ -309,7 +443,11 @@ if __name__ == "__main__":
 
     logger.info('Running %s processes', POOL_SIZE)
 
-    queue_tile(root, args.max_zoom, source_index, output)
+    if args.metatile > 1:
+        queue_metatiles(root, args.max_zoom, args.metatile, source_index,
+                        output)
+    else:
+        queue_tile(root, args.max_zoom, source_index, output)
 
     POOL.close()
     POOL.join()
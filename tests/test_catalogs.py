@@ -0,0 +1,124 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import mercantile
+from marblecutter import WEB_MERCATOR_CRS
+from marblecutter.utils import Bounds
+
+from tilezen.catalogs import CachingCatalog, MemoryCatalog, SnapshotCatalog
+
+TILE = mercantile.Tile(1205, 1539, 12)
+RESOLUTION = (38.2, 38.2)
+
+
+class FakeCatalog(object):
+    """Returns a source per 1km (in x) of the bounds it's queried with."""
+
+    def __init__(self):
+        self.queries = []
+
+    def get_sources(self, bounds, resolution, **kwargs):
+        self.queries.append(bounds)
+        (left, _, right, _) = bounds.bounds
+
+        return ["{}:{}".format(x, kwargs.get("min_zoom"))
+                for x in range(int(left // 1000), int(right // 1000) + 1)]
+
+
+def _footprint(url, resolution, x, min_zoom=0, max_zoom=20):
+    from shapely.geometry import box
+
+    return (box(x - 1, -1, x + 1, 1), {
+        "url": url,
+        "source": url,
+        "resolution": resolution,
+        "priority": 0,
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+    })
+
+
+def _buffered(tile, buffer):
+    (left, bottom, right, top) = mercantile.xy_bounds(tile)
+
+    return Bounds((left - buffer, bottom - buffer, right + buffer,
+                   top + buffer), WEB_MERCATOR_CRS)
+
+
+def test_cached_sources_match_uncached():
+    catalog = FakeCatalog()
+    cached = CachingCatalog(catalog)
+    # a cell is ~2.4km at zoom 12; these buffers snap to different cells
+    requests = [_buffered(tile, buffer)
+                for tile in (TILE, mercantile.Tile(1206, 1539, 12))
+                for buffer in (0, 3000, 6000)]
+
+    for bounds in requests:
+        assert (cached.get_sources(bounds, RESOLUTION) ==
+                FakeCatalog().get_sources(bounds, RESOLUTION))
+        # the wrapped catalog is queried with the requested bounds
+        assert catalog.queries[-1] == bounds
+
+    assert cached.stats["misses"] == len(requests)
+
+    for bounds in requests:
+        assert (cached.get_sources(bounds, RESOLUTION) ==
+                FakeCatalog().get_sources(bounds, RESOLUTION))
+
+    assert cached.stats["hits"] == len(requests)
+
+
+def test_buffered_requests_share_entries():
+    catalog = FakeCatalog()
+    cached = CachingCatalog(catalog)
+
+    first = cached.get_sources(_buffered(TILE, 0), RESOLUTION)
+
+    assert cached.get_sources(_buffered(TILE, 300), RESOLUTION) == first
+    assert len(catalog.queries) == 1
+
+    # other arguments are part of the key
+    assert (cached.get_sources(_buffered(TILE, 300), RESOLUTION,
+                               min_zoom=3) ==
+            FakeCatalog().get_sources(_buffered(TILE, 300), RESOLUTION,
+                                      min_zoom=3))
+    assert len(catalog.queries) == 2
+
+
+def test_memory_catalog_truncates_resolutions():
+    catalog = MemoryCatalog()
+
+    # both resolutions truncate to 30m, so the nearer source comes first
+    for (geometry, attributes) in [_footprint("far", 30.4, 0.5),
+                                   _footprint("near", 30.6, 0),
+                                   _footprint("coarse", 31, 0)]:
+        catalog.add_source(geometry, attributes)
+
+    bounds = Bounds((-1000, -1000, 1000, 1000), WEB_MERCATOR_CRS)
+
+    assert [source.url for source in catalog.get_sources(
+        bounds, RESOLUTION)] == ["near", "far", "coarse"]
+
+
+def test_snapshot_zoom_ranges(tmpdir):
+    path = str(tmpdir.join("footprints.snapshot"))
+    SnapshotCatalog.write(path, [_footprint("low", 1000, 0, 0, 8),
+                                 _footprint("mid", 90, 0, 9, 11),
+                                 _footprint("high", 30, 0, 12, 20)])
+    catalog = SnapshotCatalog(path)
+    bounds = Bounds((-1000, -1000, 1000, 1000), WEB_MERCATOR_CRS)
+
+    # RESOLUTION is zoom 12
+    assert [source.url for source in catalog.get_sources(
+        bounds, RESOLUTION)] == ["high"]
+    assert [source.url for source in catalog.get_sources(
+        bounds, RESOLUTION, min_zoom=8, max_zoom=10)] == ["mid", "low"]
+
+
+def test_empty_snapshot(tmpdir):
+    path = str(tmpdir.join("empty.snapshot"))
+
+    assert SnapshotCatalog.write(path, []) == 0
+    assert SnapshotCatalog(path).get_sources(
+        Bounds((-1000, -1000, 1000, 1000), WEB_MERCATOR_CRS), RESOLUTION,
+        min_zoom=0, max_zoom=20) == []
@@ -0,0 +1,66 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import numpy as np
+
+from marblecutter import WEB_MERCATOR_CRS, PixelCollection
+from marblecutter.utils import Bounds
+from rasterio.io import MemoryFile
+
+from tilezen.formats import geotiff
+
+# ~0.6m pixels, fine enough that float data isn't downsampled to int16
+BOUNDS = Bounds((0, 0, 150, 150), WEB_MERCATOR_CRS)
+
+
+def _read_back(format, data):
+    (content_type, tiff) = format(
+        PixelCollection(np.ma.masked_array(data), BOUNDS), "raw")
+
+    assert content_type == "image/tiff"
+
+    with MemoryFile(tiff) as memfile, memfile.open() as dataset:
+        return (dataset.tags(ns="IMAGE_STRUCTURE"), dataset.read(1),
+                dataset.dtypes[0])
+
+
+def _elevation(dtype):
+    return (np.arange(256 * 256).reshape((1, 256, 256)) % 1000 -
+            400.25).astype(dtype)
+
+
+def test_default_compression():
+    (tags, data, dtype) = _read_back(geotiff.format(),
+                                     _elevation(np.float32))
+
+    assert tags["COMPRESSION"] == "DEFLATE"
+    assert tags["PREDICTOR"] == "3"
+    assert dtype == "float32"
+    np.testing.assert_array_equal(data, _elevation(np.float32)[0])
+
+
+def test_zstd_floating_point_predictor():
+    (tags, data, _) = _read_back(
+        geotiff.format(compress="zstd", level=15), _elevation(np.float32))
+
+    assert tags["COMPRESSION"] == "ZSTD"
+    assert tags["PREDICTOR"] == "3"
+    np.testing.assert_array_equal(data, _elevation(np.float32)[0])
+
+
+def test_integer_predictor():
+    (tags, data, dtype) = _read_back(
+        geotiff.format(compress="deflate", level=9), _elevation(np.int16))
+
+    assert tags["COMPRESSION"] == "DEFLATE"
+    assert tags["PREDICTOR"] == "2"
+    assert dtype == "int16"
+    np.testing.assert_array_equal(data, _elevation(np.int16)[0])
+
+
+def test_precision():
+    (_, data, _) = _read_back(
+        geotiff.format(compress="zstd", precision=0.1),
+        _elevation(np.float32))
+
+    assert np.abs(data - _elevation(np.float32)[0]).max() <= 0.05
@@ -0,0 +1,70 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import numpy as np
+
+from tilezen.transformations.normal import _height_mapping, _normal_map
+
+
+def _baseline(data, dx, dy):
+    """The np.gradient / einsum implementation _normal_map replaced."""
+    ygrad, xgrad = np.gradient(np.ma.getdata(data), 2)
+    img = np.dstack((-1.0 / dx * xgrad, 1.0 / dy * ygrad,
+                     np.ones(data.shape)))
+    norm = np.sqrt(np.einsum('ijk,ijk->ij', img, img))
+    img = np.clip(128.0 * (img / norm[:, :, np.newaxis] + 1.0), 0.0,
+                  255.0).astype(np.uint8)
+    hyps = _height_mapping(np.ma.getdata(data))
+    hyps[np.ma.getmaskarray(data)] = 0
+
+    return np.dstack((img, hyps))
+
+
+def _elevation(seed, shape=(260, 260), dtype=np.float32):
+    random = np.random.RandomState(seed)
+    data = np.cumsum(np.cumsum(random.normal(0, 5, shape), 0), 1)
+
+    return np.ma.masked_array(
+        (data + random.uniform(-3000, 3000)).astype(dtype))
+
+
+def test_float64_matches_baseline():
+    for seed in range(5):
+        for (data, resolution) in [(_elevation(seed, dtype=dtype), resolution)
+                                   for dtype in (np.float32, np.float64)
+                                   for resolution in (0.3, 2, 20, 150)]:
+            np.testing.assert_array_equal(
+                _normal_map(data, resolution, resolution),
+                _baseline(data, resolution, resolution))
+
+
+def test_float32_within_1_of_baseline():
+    for seed in range(5):
+        data = _elevation(seed)
+
+        for resolution in (0.3, 2, 20, 150):
+            difference = np.abs(
+                _normal_map(data, resolution, resolution,
+                            dtype=np.float32).astype(int) -
+                _baseline(data, resolution, resolution).astype(int))
+
+            assert difference.max() <= 1
+            # hypsometric indexes are computed from the original values
+            assert difference[:, :, 3].max() == 0
+
+
+def test_nodata_does_not_leak():
+    data = _elevation(0)
+    data[100:120, 100:120] = np.ma.masked
+
+    filled = np.ma.getdata(data).copy()
+    filled[np.ma.getmaskarray(data)] = -32768
+    nodata = np.ma.masked_array(filled, mask=np.ma.getmaskarray(data))
+
+    # the values under the mask don't matter
+    np.testing.assert_array_equal(
+        _normal_map(data, 20, 20), _normal_map(nodata, 20, 20))
+
+    # pixels whose neighbors are all valid match the baseline
+    np.testing.assert_array_equal(
+        _normal_map(data, 20, 20)[:90], _baseline(data, 20, 20)[:90])
@@ -0,0 +1,43 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import numpy as np
+import pytest
+
+from tilezen.transformations.terrarium import decode
+
+
+def _encode(elevation):
+    uheight = elevation + 32768.0
+    whole = uheight.astype(np.uint16)
+
+    return np.dstack((whole >> 8, whole & 0xFF,
+                      (uheight - whole) * 256)).astype(np.uint8)
+
+
+def test_decode_rgb():
+    elevation = np.array([[-10.5, 0], [1234.25, 8848]], dtype=np.float32)
+    rgb = _encode(elevation)
+    rgb[0, 1, 0] = 0
+
+    decoded = decode(rgb)
+
+    np.testing.assert_array_equal(decoded.data[~decoded.mask],
+                                  elevation[[0, 1, 1], [0, 0, 1]])
+    assert decoded.mask.tolist() == [[False, True], [False, False]]
+
+
+def test_decode_rgba_masks_transparent_pixels():
+    elevation = np.array([[-10.5, 0], [1234.25, 8848]], dtype=np.float32)
+    rgba = np.dstack((_encode(elevation), np.full((2, 2), 255, np.uint8)))
+    rgba[1, 1, 3] = 0
+
+    decoded = decode(rgba)
+
+    assert decoded.mask.tolist() == [[False, False], [False, True]]
+    np.testing.assert_array_equal(decoded.data[0], elevation[0])
+
+
+def test_decode_rejects_other_band_counts():
+    with pytest.raises(Exception):
+        decode(np.zeros((2, 2, 2), dtype=np.uint8))
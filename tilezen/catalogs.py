@@ -1,79 +1,340 @@
 # coding=utf-8
+import hashlib
 import json
 import logging
+import os
+import sqlite3
+import threading
 import traceback
 
 import dateutil.parser
+import numpy as np
+from cachetools import LRUCache, TTLCache
 
+import mercantile
 import pyspatialite.dbapi2 as spatialite
-from marblecutter import get_zoom
+from marblecutter import WEB_MERCATOR_CRS, _nodata, get_zoom
 from marblecutter.catalogs import WGS84_CRS, Catalog
 from marblecutter.utils import Bounds, Source
-from rasterio import warp
+from rasterio import transform, warp
+from rasterio.io import MemoryFile
+
+from . import snapshot
+from .postgis import get_pool
+from .transformations import terrarium
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 Infinity = float("inf")
 LOG = logging.getLogger(__name__)
 
 
+def _json(value):
+    """Parse a JSON attribute (unless the driver already has)."""
+    if value is None:
+        return {}
+
+    if isinstance(value, (dict, list)):
+        return value
+
+    return json.loads(value)
+
+
+def _source(geometry, attributes):
+    """
+    Build a Source from a footprint's geometry and attributes (as provided by
+    PostGISFootprints).
+    """
+    from shapely.geometry import mapping
+
+    acquired_at = attributes.get("acquired_at")
+
+    if hasattr(acquired_at, "isoformat"):
+        acquired_at = acquired_at.isoformat()
+
+    return Source(
+        url=attributes["url"],
+        name=attributes["source"],
+        resolution=attributes["resolution"],
+        band_info=_json(attributes.get("band_info")),
+        meta=_json(attributes.get("meta")),
+        recipes=_json(attributes.get("recipes")),
+        acquired_at=acquired_at,
+        priority=attributes["priority"],
+        geom=mapping(geometry),
+        filename=attributes.get("filename"),
+        min_zoom=attributes["min_zoom"],
+        max_zoom=attributes["max_zoom"])
+
+
+def _connect_read_only(driver, path):
+    """
+    Open the SQLite database at `path` read-only with `driver` (sqlite3 or
+    pyspatialite): using a URI where the driver supports them (immutable if
+    the file can't be written, e.g. when it's part of a read-only bundle),
+    otherwise with PRAGMA query_only (which is checked, since SQLite before
+    3.8.0 ignores it).
+    """
+    if not os.path.exists(path):
+        raise Exception("{} doesn't exist".format(path))
+
+    mode = "mode=ro" if os.access(path, os.W_OK) else "immutable=1"
+
+    try:
+        return driver.connect(
+            "file:{}?{}".format(quote(os.path.abspath(path)), mode),
+            uri=True)
+    except TypeError:
+        # this driver (e.g. Python 2's) can't open URIs
+        pass
+
+    conn = driver.connect(path)
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("PRAGMA query_only = ON")
+        cursor.execute("PRAGMA query_only")
+
+        if cursor.fetchone() != (1, ):
+            raise Exception(
+                "SQLite {} can't open read-only connections".format(
+                    driver.sqlite_version))
+    except Exception as e:
+        conn.close()
+        LOG.warn(e)
+        raise e
+    finally:
+        cursor.close()
+
+    return conn
+
+
+def _zoom_range(resolution, min_zoom=None, max_zoom=None):
+    """
+    Get the range of zooms to select sources for: those given, defaulting to
+    the zoom equivalent to `resolution`.
+    """
+    zoom = get_zoom(max(resolution))
+
+    return (zoom if min_zoom is None else min_zoom,
+            zoom if max_zoom is None else max_zoom)
+
+
+def _select_sources(ids, columns, zooms, bounds_geom, geometry, attributes,
+                    max_zoom_inclusive):
+    """
+    Filter candidate sources (`ids`, rows of a MemoryCatalog.COLUMNS array
+    whose envelopes intersect `bounds_geom`) to those used at any of `zooms`
+    (a (min, max) range) that intersect it, and order them by priority,
+    resolution (truncated to whole meters, as MemoryCatalog always has) and
+    distance. `geometry` and `attributes` look up a candidate's geometry and
+    attributes by id.
+    """
+    from shapely.prepared import prep
+
+    bounds_centroid = bounds_geom.centroid
+    prepared_bounds = prep(bounds_geom)
+
+    # Filter by zoom level
+    (min_zoom, max_zoom) = columns[ids, :2].T
+    if max_zoom_inclusive:
+        matches = (min_zoom <= zooms[1]) & (zooms[0] <= max_zoom)
+    else:
+        matches = (min_zoom <= zooms[1]) & (zooms[0] < max_zoom)
+    ids = ids[matches]
+
+    # Filter by intersecting geometries; indexes only compare envelopes,
+    # so check hits exactly
+    geometries = {}
+
+    for i in ids:
+        geometries[i] = geometry(i)
+
+    ids = ids[np.array(
+        [prepared_bounds.intersects(geometries[i]) for i in ids],
+        dtype=bool)]
+
+    # Sort by priority, resolution and centroid distance
+    (priority, res, x, y) = columns[ids, 2:].T
+    dx = x - bounds_centroid.x
+    dy = y - bounds_centroid.y
+    ids = ids[np.lexsort((np.sqrt(dx * dx + dy * dy), np.trunc(res),
+                          priority))]
+
+    # Remove duplicate URLs
+    seen = set()
+    results = []
+    for i in ids:
+        source_attributes = attributes(i)
+
+        if source_attributes["url"] not in seen:
+            seen.add(source_attributes["url"])
+            results.append(_source(geometries[i], source_attributes))
+
+    return results
+
+
 class MemoryCatalog(Catalog):
-    def __init__(self):
-        self._sources = []
+    """
+    A catalog of footprints held in memory.
+
+    Footprints are stored in columns: geometries and attributes in lists,
+    and the values used to filter and sort them in a NumPy array
+    (see COLUMNS). Sources added since the last query are buffered as rows
+    until the next query folds them into the array and rebuilds the
+    STR-tree.
+    """
+
+    COLUMNS = ("min_zoom", "max_zoom", "priority", "resolution", "centroid_x",
+               "centroid_y")
+
+    def __init__(self, max_zoom_inclusive=False):
+        # PostGIS catalogs treat max_zoom as inclusive; pyramids don't
+        self.max_zoom_inclusive = max_zoom_inclusive
+        self._geometries = []
+        self._attributes = []
+        # one row per source, in COLUMNS order
+        self._columns = np.empty((0, len(self.COLUMNS)))
+        self._pending = []
+        # STR-tree over self._geometries, built on demand
+        self._tree = None
+        self._tree_ids = None
+        self._tree_lock = threading.Lock()
 
     def add_source(self, geometry, attributes):
-        self._sources.append((geometry, attributes))
+        centroid = geometry.centroid
 
-    def get_sources(self, bounds, resolution):
+        with self._tree_lock:
+            self._geometries.append(geometry)
+            self._attributes.append(attributes)
+            self._pending.append(
+                (attributes['min_zoom'], attributes['max_zoom'],
+                 attributes['priority'], attributes['resolution'],
+                 centroid.x, centroid.y))
+            self._tree = None
+
+    def _index(self):
+        """
+        Fold pending sources into the column array and bulk-load an STR-tree
+        from the current geometries (once; adding a source invalidates it).
+        Returns the tree, a function mapping query hits to source ids and the
+        column array.
+        """
+        from shapely.strtree import STRtree
+
+        with self._tree_lock:
+            if self._tree is None and self._geometries:
+                self._columns = np.concatenate(
+                    (self._columns, np.array(self._pending, dtype=np.float64)
+                     .reshape(-1, len(self.COLUMNS))))
+                self._pending = []
+
+                # sources may share geometry objects, so each distinct
+                # geometry is indexed once and maps to all of its sources
+                geometries = []
+                source_ids = {}
+
+                for i, geom in enumerate(self._geometries):
+                    if id(geom) not in source_ids:
+                        geometries.append(geom)
+                        source_ids[id(geom)] = []
+
+                    source_ids[id(geom)].append(i)
+
+                # Shapely 2 returns indexes rather than geometries
+                self._tree_ids = lambda hit: source_ids[id(
+                    geometries[hit]
+                    if isinstance(hit, (int, np.integer)) else hit)]
+                self._tree = STRtree(geometries)
+
+            return self._tree, self._tree_ids, self._columns
+
+    def get_sources(self, bounds, resolution, min_zoom=None, max_zoom=None):
         from shapely.geometry import box
 
         bounds, bounds_crs = bounds
 
-        results = []
-        zoom = get_zoom(max(resolution))
+        zooms = _zoom_range(resolution, min_zoom, max_zoom)
         ((left, right), (bottom, top)) = warp.transform(
             bounds_crs, WGS84_CRS, bounds[::2], bounds[1::2])
         bounds_geom = box(left, bottom, right, top)
-        bounds_centroid = bounds_geom.centroid
-
-        # Filter by zoom level and intersecting geometries
-        for candidate in self._sources:
-            (geom, attr) = candidate
-            if attr['min_zoom'] <= zoom < attr['max_zoom'] and \
-               geom.intersects(bounds_geom):
-                results.append(candidate)
-
-        # Sort by resolution and centroid distance
-        results = sorted(
-            results,
-            key=lambda (geom, attr): (
-                attr['priority'],
-                int(attr['resolution']),
-                bounds_centroid.distance(geom.centroid),
-            )
-        )
-
-        # Remove duplicate URLs
-        # From https://stackoverflow.com/a/480227
-        seen = set()
-        seen_add = seen.add
-        results = [
-            x for x in results
-            if not (x[1]['url'] in seen or seen_add(x[1]['url']))
-        ]
-
-        # Pick only the attributes we care about
-        results = [(a['url'], a['source'], a['resolution'])
-                   for (_, a) in results]
-
-        return results
+
+        (tree, tree_ids, columns) = self._index()
+
+        if tree is None:
+            return []
+
+        # keep insertion order so that ties sort the same way as they would
+        # in a scan
+        ids = np.array(
+            sorted(i for hit in tree.query(bounds_geom)
+                   for i in tree_ids(hit)),
+            dtype=np.intp)
+
+        return _select_sources(ids, columns, zooms, bounds_geom,
+                               self._geometries.__getitem__,
+                               self._attributes.__getitem__,
+                               self.max_zoom_inclusive)
 
 
 class SpatialiteCatalog(Catalog):
-    def __init__(self):
-        self.conn = spatialite.connect(":memory:")
+    INSERT = """
+INSERT INTO footprints (
+    source,
+    filename,
+    url,
+    resolution,
+    min_zoom,
+    max_zoom,
+    priority,
+    meta,
+    recipes,
+    band_info,
+    acquired_at,
+    geom
+) VALUES (
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    ?,
+    date(?),
+    SetSRID({geometry}, 4326)
+)
+    """
+
+    def __init__(self, path=":memory:", uncovered_threshold=0,
+                 read_only=False):
+        """
+        Create an in-memory catalog, or open (or create) one stored at `path`
+        (see `save`). Snapshots opened with `read_only` can be shared by
+        several workers.
+        """
+        # stop selecting sources once less than this fraction of a tile is
+        # uncovered
+        self.uncovered_threshold = uncovered_threshold
+        exists = path != ":memory:" and os.path.exists(path)
+
+        if read_only:
+            self.conn = _connect_read_only(spatialite, path)
+        else:
+            self.conn = spatialite.connect(path)
+
+        if exists:
+            return
 
         cursor = self.conn.cursor()
 
         try:
+
             cursor.execute("SELECT InitSpatialMetadata()")
 
             cursor.execute("""
@@ -95,7 +356,6 @@ CREATE TABLE footprints (
             cursor.execute("""
 SELECT AddGeometryColumn('footprints', 'geom', 4326, 'MULTIPOLYGON', 'XY')
             """)
-            cursor.execute("SELECT CreateSpatialIndex('footprints', 'geom')")
 
             self.conn.commit()
         except Exception as e:
@@ -104,45 +364,31 @@ SELECT AddGeometryColumn('footprints', 'geom', 4326, 'MULTIPOLYGON', 'XY')
         finally:
             cursor.close()
 
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Open a snapshot written by `save` read-only."""
+        if not os.path.exists(path):
+            raise Exception("No catalog snapshot at {}".format(path))
+
+        return cls(path, read_only=True, **kwargs)
+
+    @staticmethod
+    def _row(source):
+        return (source.name, source.filename, source.url, source.resolution,
+                source.min_zoom, source.max_zoom, source.priority,
+                json.dumps(source.meta), json.dumps(source.recipes),
+                json.dumps(source.band_info), None
+                if source.acquired_at is None else
+                dateutil.parser.parse(source.acquired_at).isoformat(),
+                json.dumps(source.geom))
+
     def add_source(self, source):
         cursor = self.conn.cursor()
 
         try:
-            cursor.execute("""
-INSERT INTO footprints (
-    source,
-    filename,
-    url,
-    resolution,
-    min_zoom,
-    max_zoom,
-    priority,
-    meta,
-    recipes,
-    band_info,
-    acquired_at,
-    geom
-) VALUES (
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    ?,
-    date(?),
-    SetSRID(GeomFromGeoJSON(?), 4326)
-)
-            """, (source.name, source.filename, source.url, source.resolution,
-                  source.min_zoom, source.max_zoom, source.priority,
-                  json.dumps(source.meta), json.dumps(source.recipes),
-                  json.dumps(source.band_info), None
-                  if source.acquired_at is None else
-                  dateutil.parser.parse(source.acquired_at).isoformat(),
-                  json.dumps(source.geom)))
+            cursor.execute(
+                self.INSERT.format(geometry="GeomFromGeoJSON(?)"),
+                self._row(source))
 
             self.conn.commit()
         except Exception as e:
@@ -151,6 +397,97 @@ INSERT INTO footprints (
         finally:
             cursor.close()
 
+    def _insert_many(self, rows, geometry):
+        """Insert rows in a single transaction."""
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.executemany(self.INSERT.format(geometry=geometry), rows)
+
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            LOG.warn(e)
+            raise e
+        finally:
+            cursor.close()
+
+    def add_sources(self, sources):
+        """Bulk load an iterable of Sources."""
+        self._insert_many((self._row(source) for source in sources),
+                          "GeomFromGeoJSON(?)")
+
+    def save(self, path):
+        """Write the catalog to a new SQLite file at `path`."""
+        if os.path.exists(path):
+            raise Exception("{} already exists".format(path))
+
+        snapshot = SpatialiteCatalog(path)
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute("""
+SELECT
+  source,
+  filename,
+  url,
+  resolution,
+  min_zoom,
+  max_zoom,
+  priority,
+  meta,
+  recipes,
+  band_info,
+  acquired_at,
+  AsBinary(geom)
+FROM footprints
+            """)
+
+            snapshot._insert_many(cursor, "GeomFromWKB(?)")
+        finally:
+            cursor.close()
+            snapshot.conn.close()
+
+    def footprints(self):
+        """
+        Yield (geometry, attributes) pairs for all footprints, e.g. to write
+        a SnapshotCatalog.
+        """
+        from shapely import wkb
+
+        cursor = self.conn.cursor()
+
+        try:
+            cursor.execute("""
+SELECT
+  url,
+  source,
+  resolution,
+  min_zoom,
+  max_zoom,
+  coalesce(priority, 0.5) priority,
+  filename,
+  band_info,
+  meta,
+  recipes,
+  acquired_at,
+  AsBinary(geom)
+FROM footprints
+            """)
+
+            for record in cursor:
+                yield (wkb.loads(bytes(record[-1])),
+                       dict(
+                           zip(("url", "source", "resolution", "min_zoom",
+                                "max_zoom", "priority", "filename",
+                                "band_info", "meta", "recipes",
+                                "acquired_at"), record[:-1])))
+        except Exception as e:
+            LOG.warn(e)
+            raise e
+        finally:
+            cursor.close()
+
     def _candidates(self, bounds, resolution):
         cursor = self.conn.cursor()
 
@@ -227,14 +564,14 @@ FROM sources
         right = right if right != Infinity else 180
         top = top if top != Infinity else 90
 
+        # candidates are ranked by how much of the tile they cover (not how
+        # much of what's left), so their order doesn't change as sources are
+        # selected; fetch them all at once and pick greedily
         try:
-            query = """
+            cursor.execute("""
 WITH bbox AS (
   SELECT SetSRID(GeomFromGeoJSON(?), 4326) geom
 ),
-uncovered AS (
-  SELECT SetSRID(GeomFromGeoJSON(?), 4326) geom
-),
 date_range AS (
   SELECT
     COALESCE(min(acquired_at), date('1970-01-01')) min,
@@ -245,19 +582,15 @@ SELECT
   url,
   source,
   resolution,
-  coalesce(band_info, '{{}}') band_info,
-  coalesce(meta, '{{}}') meta,
-  coalesce(recipes, '{{}}') recipes,
+  coalesce(band_info, '{}') band_info,
+  coalesce(meta, '{}') meta,
+  coalesce(recipes, '{}') recipes,
   acquired_at,
   null band, -- for Source constructor compatibility
   priority,
-  ST_Area(ST_Intersection(uncovered.geom, footprints.geom)) /
-    ST_Area(bbox.geom) coverage,
-  AsGeoJSON(footprints.geom) geom,
-  AsGeoJSON(ST_Difference(uncovered.geom, footprints.geom)) uncovered
+  AsGeoJSON(footprints.geom) geom
 FROM bbox, date_range, footprints
-JOIN uncovered ON ST_Intersects(footprints.geom, uncovered.geom)
-WHERE footprints.url NOT IN ({url_placeholders})
+WHERE ST_Intersects(footprints.geom, bbox.geom)
   AND ? BETWEEN min_zoom AND max_zoom
 ORDER BY
   10 * coalesce(footprints.priority, 0.5) *
@@ -273,41 +606,896 @@ ORDER BY
     ST_Area(
         ST_Intersection(bbox.geom, footprints.geom)) /
       ST_Area(bbox.geom) DESC
-LIMIT 1
-            """
-
-            bbox = json.dumps({
+            """, (json.dumps({
                 "type":
                 "Polygon",
                 "coordinates": [[[left, bottom], [left, top], [right, top],
                                  [right, bottom], [left, bottom]]]
-            })
+            }), zoom, min(resolution)))
 
-            uncovered = bbox
-            urls = set()
+            candidates = cursor.fetchall()
+        except Exception as e:
+            LOG.warn(e)
+            LOG.warn(traceback.format_exc(e))
+            return
+        finally:
+            cursor.close()
 
-            while True:
-                url_placeholders = ", ".join("?" * len(urls))
-                cursor.execute(
-                    query.format(url_placeholders=url_placeholders),
-                    (bbox, uncovered) + tuple(urls) + (zoom, min(resolution)))
+        for source in self._cover(candidates, (left, bottom, right, top)):
+            yield source
 
-                count = 0
-                for record in cursor:
-                    count += 1
-                    yield Source(*record[:-1])
+    def _cover(self, candidates, bounds):
+        """
+        Greedily select candidates (in order) that cover part of what's still
+        uncovered, until nothing (or less than uncovered_threshold of the
+        bounds) is left.
+        """
+        from shapely.geometry import box, shape
+        from shapely.prepared import prep
 
-                    urls.add(record[0])
-                    uncovered = record[-1]
+        bbox = box(*bounds)
+        threshold = self.uncovered_threshold * bbox.area
+        uncovered = bbox
+        prepared = prep(uncovered)
+        urls = set()
 
-                if count == 0:
-                    break
+        for record in candidates:
+            if uncovered.is_empty or uncovered.area <= threshold:
+                break
 
-        except Exception as e:
-            LOG.warn(e)
-            LOG.warn(traceback.format_exc(e))
+            url = record[0]
+            geom = record[-1]
+
+            if url in urls:
+                continue
+
+            footprint = shape(json.loads(geom))
+
+            if not prepared.intersects(footprint):
+                continue
+
+            coverage = uncovered.intersection(footprint).area / bbox.area
+
+            yield Source(*(tuple(record[:-1]) + (coverage, geom)))
+
+            urls.add(url)
+            uncovered = uncovered.difference(footprint)
+            prepared = prep(uncovered)
+
+
+class _MemoryFileURL(str):
+    """A MemoryFile's URL that keeps the file open while it's referenced."""
+
+    def __new__(cls, owner):
+        url = str.__new__(cls, owner.memfile.name)
+        url.owner = owner
+
+        return url
+
+
+class _SharedMemoryFile(object):
+    """
+    Owns a MemoryFile and closes it once nothing refers to it: not the cache
+    it's held in, nor any URL handed out for it (e.g. in Sources that a
+    concurrent render has yet to open), so eviction can't release a file
+    that's still in use.
+    """
+
+    def __init__(self, memfile):
+        self.memfile = memfile
+
+    @property
+    def url(self):
+        return _MemoryFileURL(self)
+
+    def __del__(self):
+        self.memfile.close()
+
+
+class TileCatalog(Catalog):
+    """
+    A catalog backed by an already-rendered pyramid of terrarium PNG or
+    GeoTIFF tiles, either in a directory (`path` is a template, e.g.
+    "tiles/{z}/{x}/{y}.png") or in an MBTiles file.
+
+    Tiles are decoded back into float32 elevations and exposed as in-memory
+    GeoTIFFs, so they can be used with `tiling.render_tile` like any other
+    catalog. Tiles beyond `max_zoom` are read from `max_zoom` (and upsampled
+    when mosaicking).
+    """
+
+    def __init__(self,
+                 path,
+                 encoding="terrarium",
+                 min_zoom=0,
+                 max_zoom=15,
+                 cache_size=256):
+        if encoding not in ("terrarium", "geotiff"):
+            raise Exception("Unsupported tile encoding: {}".format(encoding))
+
+        self._path = path
+        self._encoding = encoding
+        self._min_zoom = min_zoom
+        self._max_zoom = max_zoom
+        self._cache = LRUCache(cache_size)
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path.endswith(".mbtiles"):
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    @property
+    def maxzoom(self):
+        return self._max_zoom
+
+    @property
+    def minzoom(self):
+        return self._min_zoom
+
+    @property
+    def name(self):
+        return os.path.basename(self._path)
+
+    def _read(self, tile):
+        if self._conn is None:
+            filename = self._path.format(z=tile.z, x=tile.x, y=tile.y)
+
+            if not os.path.exists(filename):
+                return None
+
+            with open(filename, "rb") as f:
+                return f.read()
+
+        # MBTiles stores rows in TMS order (origin in the lower left)
+        with self._lock:
+            row = self._conn.execute("""
+SELECT tile_data
+FROM tiles
+WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+            """, (tile.z, tile.x, (2**tile.z) - 1 - tile.y)).fetchone()
+
+        if row is None:
+            return None
+
+        return bytes(row[0])
+
+    def _load(self, tile):
+        data = self._read(tile)
+
+        if data is None:
+            return None
+
+        if self._encoding == "geotiff":
+            # already georeferenced; GDAL decodes it when it's read
+            memfile = MemoryFile(data)
+
+            with memfile.open() as dataset:
+                (resolution, _) = dataset.res
+
+            return _SharedMemoryFile(memfile), resolution
+
+        elevation = terrarium.read(data)
+        (height, width) = elevation.shape
+        bounds = mercantile.xy_bounds(tile)
+        nodata = _nodata(np.float32)
+
+        memfile = MemoryFile(
+            filename="{}-{}-{}.tif".format(tile.z, tile.x, tile.y))
+
+        with memfile.open(
+                driver="GTiff",
+                count=1,
+                crs=WEB_MERCATOR_CRS,
+                dtype=np.float32,
+                nodata=nodata,
+                height=height,
+                width=width,
+                transform=transform.from_bounds(
+                    *bounds, width=width, height=height)) as dataset:
+            dataset.write(elevation.filled(nodata), 1)
+
+        return _SharedMemoryFile(memfile), (bounds.right - bounds.left) / width
+
+    def _get(self, tile):
+        with self._lock:
+            if tile in self._cache:
+                return self._cache[tile]
+
+        entry = self._load(tile)
+
+        with self._lock:
+            if tile in self._cache:
+                # another thread got here first (the unused entry closes its
+                # file when it's released)
+                return self._cache[tile]
+
+            self._cache[tile] = entry
+
+        return entry
+
+    def get_sources(self, bounds, resolution):
+        zoom = min(max(get_zoom(max(resolution)), self._min_zoom),
+                   self._max_zoom)
+
+        if bounds.crs == WGS84_CRS:
+            left, bottom, right, top = bounds.bounds
+        else:
+            left, bottom, right, top = warp.transform_bounds(
+                bounds.crs, WGS84_CRS, *bounds.bounds)
+
+        left = max(left, -180)
+        bottom = max(bottom, -85.0511)
+        right = min(right, 180)
+        top = min(top, 85.0511)
+
+        for tile in mercantile.tiles(left, bottom, right, top, [zoom]):
+            entry = self._get(tile)
+
+            if entry is None:
+                continue
+
+            (memfile, tile_resolution) = entry
+
+            yield Source(
+                url=memfile.url,
+                name=self.name,
+                resolution=tile_resolution,
+                min_zoom=self._min_zoom,
+                max_zoom=self._max_zoom)
+
+
+class CachingCatalog(object):
+    """
+    Wraps a catalog, caching its sources for `ttl` seconds (footprints
+    rarely change; call `invalidate` when they do).
+
+    Entries are keyed on the requested bounds snapped to the nearest lines
+    of a grid of `cells` x `cells` cells per tile at the requested zoom, so
+    that a tile and its slightly buffered variants share them. The wrapped
+    catalog is queried with the exact bounds of the request that fills an
+    entry; requests that hit it get those sources, although their own
+    bounds may differ by up to a cell.
+
+    Everything other than `get_sources` is passed through to the wrapped
+    catalog.
+    """
+
+    def __init__(self, catalog, ttl=300, maxsize=4096, cells=4):
+        self.catalog = catalog
+        self.cells = cells
+        self.hits = 0
+        self.misses = 0
+        self._cache = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+    def _key(self, bounds, resolution, kwargs):
+        (bounds, bounds_crs) = bounds
+        zoom = get_zoom(max(resolution))
+
+        if bounds_crs.is_geographic:
+            extent = 360.
+        else:
+            extent = 2 * 20037508.342789244
+
+        cell = extent / 2**zoom / self.cells
+        snapped = tuple(int(np.round(x / cell)) for x in bounds)
+
+        return (snapped, bounds_crs.to_string(), zoom,
+                tuple(sorted(kwargs.items())))
+
+    def get_sources(self, bounds, resolution, **kwargs):
+        key = self._key(bounds, resolution, kwargs)
+
+        with self._lock:
+            sources = self._cache.get(key)
+
+            if sources is not None:
+                self.hits += 1
+                return sources
+
+            self.misses += 1
+
+        sources = list(
+            self.catalog.get_sources(bounds, resolution, **kwargs))
+
+        with self._lock:
+            self._cache[key] = sources
+
+        return sources
+
+    def invalidate(self):
+        """Drop all cached sources."""
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._cache),
+            }
+
+
+class PostGISFootprints(object):
+    """
+    Fetches footprints (geometries and attributes) intersecting bounds from
+    PostGIS, e.g. to populate a MemoryCatalog.
+
+    Connections are borrowed from `pool` (the shared pool for `database_url`
+    by default) and the query is prepared once per connection.
+    """
+
+    QUERY = """
+        SELECT
+            url, source, resolution, min_zoom, max_zoom,
+            priority, filename, band_info, meta, recipes, acquired_at,
+            ST_AsBinary({geometry_column}) geom
+        FROM {table}
+        WHERE {geometry_column} && ST_MakeEnvelope($1, $2, $3, $4, 4326)
+            AND ST_Intersects({geometry_column},
+                ST_MakeEnvelope($1, $2, $3, $4, 4326))
+            AND min_zoom <= $5
+            AND max_zoom >= $6
+            AND enabled = true
+    """
+
+    def __init__(self,
+                 table="footprints",
+                 database_url=os.getenv("DATABASE_URL"),
+                 geometry_column="wkb_geometry",
+                 pool=None):
+        if pool is None:
+            if database_url is None:
+                raise Exception("Database URL must be provided.")
+
+            pool = get_pool(database_url)
+
+        self.table = table
+        self.pool = pool
+        self.geometry_column = geometry_column
+        self._query = self.QUERY.format(
+            geometry_column=geometry_column, table=table)
+        self._statement = "footprints_{}".format(table.replace(".", "_"))
+
+    def __call__(self, bounds, min_zoom, max_zoom):
+        """
+        Fetch enabled footprints intersecting `bounds` (in WGS84) that are
+        used at any zoom between `min_zoom` and `max_zoom` (inclusive).
+        """
+        import psycopg2.extras
+        from shapely import wkb
+
+        footprints = []
+
+        with self.pool.connection() as conn:
+            with conn.cursor(
+                    cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                self.pool.execute(cursor, self._statement, self._query,
+                                  tuple(bounds) + (max_zoom, min_zoom))
+
+                for row in cursor:
+                    row = dict(row)
+                    footprints.append((wkb.loads(bytes(row.pop("geom"))),
+                                       row))
+
+        return footprints
+
+
+class PrefetchingCatalog(object):
+    """
+    Wraps a catalog, answering source lookups for a tile from footprints
+    prefetched for an ancestor `levels` zooms up, so that a burst of requests
+    for neighboring tiles costs a single query.
+
+    `fetch(bounds, min_zoom, max_zoom)` (e.g. a PostGISFootprints) provides
+    footprints for an ancestor's bounds (expanded slightly so that buffered
+    tiles fit). They're indexed in a MemoryCatalog, and at most `maxsize`
+    ancestors are held, each for at most `ttl` seconds.
+
+    Lookups that don't fit within an ancestor or that pass extra arguments,
+    and everything other than `get_sources`, go to the wrapped catalog.
+    """
+
+    # fraction of an ancestor's size to include on each side
+    MARGIN = 1 / 16.
+
+    def __init__(self, catalog, fetch, levels=3, maxsize=64, ttl=300):
+        self.catalog = catalog
+        self.fetch = fetch
+        self.levels = levels
+        self._ancestors = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        # ancestor -> lock held while it's being fetched
+        self._fetching = {}
+
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+    def _ancestor(self, bounds, zoom):
+        """
+        Find the ancestor used for a lookup, the range of zooms it serves,
+        and its expanded bounds.
+        """
+        (left, bottom, right, top) = bounds
+        lng = (left + right) / 2
+        lat = (bottom + top) / 2
+        ancestor = mercantile.tile(lng, lat, max(zoom - self.levels, 0))
+
+        # the root serves all zooms down to `levels`
+        min_zoom = ancestor.z + self.levels if ancestor.z > 0 else 0
+        max_zoom = ancestor.z + self.levels
+
+        (west, south, east, north) = mercantile.bounds(ancestor)
+        dx = (east - west) * self.MARGIN
+        dy = (north - south) * self.MARGIN
+
+        return (ancestor, (min_zoom, max_zoom),
+                (max(west - dx, -180), max(south - dy, -90),
+                 min(east + dx, 180), min(north + dy, 90)))
+
+    def _sources_for(self, ancestor, zooms, bounds):
+        with self._lock:
+            catalog = self._ancestors.get(ancestor)
+
+            if catalog is not None:
+                return catalog
+
+            lock = self._fetching.setdefault(ancestor, threading.Lock())
+
+        # only fetch each ancestor once, even if several threads want it
+        with lock:
+            with self._lock:
+                catalog = self._ancestors.get(ancestor)
+
+            if catalog is None:
+                catalog = MemoryCatalog(max_zoom_inclusive=True)
+
+                for (geometry, attributes) in self.fetch(bounds, *zooms):
+                    catalog.add_source(geometry, attributes)
+
+                with self._lock:
+                    self._ancestors[ancestor] = catalog
+
+        with self._lock:
+            self._fetching.pop(ancestor, None)
+
+        return catalog
+
+    def get_sources(self, bounds, resolution, **kwargs):
+        if kwargs:
+            return self.catalog.get_sources(bounds, resolution, **kwargs)
+
+        zoom = get_zoom(max(resolution))
+        (left, bottom, right, top) = warp.transform_bounds(
+            bounds.crs, WGS84_CRS, *bounds.bounds)
+
+        # Web Mercator tiles don't reach the poles
+        if max(abs(bottom), abs(top)) > 85.0511:
+            return self.catalog.get_sources(bounds, resolution)
+
+        (ancestor, zooms, ancestor_bounds) = self._ancestor(
+            (left, bottom, right, top), zoom)
+
+        if (left < ancestor_bounds[0] or bottom < ancestor_bounds[1]
+                or right > ancestor_bounds[2] or top > ancestor_bounds[3]):
+            return self.catalog.get_sources(bounds, resolution)
+
+        return self._sources_for(ancestor, zooms,
+                                 ancestor_bounds).get_sources(
+                                     bounds, resolution)
+
+
+class TileIndexCatalog(Catalog):
+    """
+    A catalog that serves source lists for tiles at low and mid zooms (up to
+    `max_zoom`) from an index materialized in SQLite (at `path`) by
+    `refresh`, so that a lookup costs a single primary key query rather than
+    a spatial join.
+
+    Each tile's entry lists the sources (as a MemoryCatalog would select
+    and order them) that intersect the tile expanded by `margin` of its size on
+    each side, so buffered requests for the tile can be served from it too.
+    Tiles with identical lists share one entry, lists refer to footprints
+    (stored once each) by id, and tiles without sources have no entry.
+
+    Indexes are created with `create`; other instances open them read-only.
+
+    Lookups that don't fit within a tile at an indexed zoom go to `catalog`
+    (or find no sources if there isn't one).
+    """
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+  name TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE TABLE IF NOT EXISTS footprints (
+  id INTEGER PRIMARY KEY,
+  digest TEXT UNIQUE NOT NULL,
+  source TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS source_lists (
+  id INTEGER PRIMARY KEY,
+  digest TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS list_footprints (
+  list_id INTEGER,
+  position INTEGER,
+  footprint_id INTEGER NOT NULL,
+  PRIMARY KEY (list_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tiles (
+  z INTEGER,
+  x INTEGER,
+  y INTEGER,
+  list_id INTEGER NOT NULL,
+  PRIMARY KEY (z, x, y)
+) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, catalog=None, cache_size=1024):
+        self.catalog = catalog
+        self.path = path
+        # held while refreshing
+        self._lock = threading.Lock()
+        # digest -> sources (list ids may be reused after a refresh)
+        self._lists = LRUCache(cache_size)
+        self._lists_lock = threading.Lock()
+        # each thread has its own (read-only) connection
+        self._local = threading.local()
+
+        metadata = dict(self._connection().execute(
+            "SELECT name, value FROM metadata"))
+
+        self.max_zoom = int(metadata["max_zoom"])
+        self.margin = float(metadata["margin"])
+
+    @classmethod
+    def create(cls, path, max_zoom=12, margin=1 / 16., **kwargs):
+        """
+        Create an empty index at `path` (an existing index keeps the settings
+        it was built with) and open it.
+        """
+        conn = sqlite3.connect(path)
+
+        try:
+            # let lookups proceed while the index is being refreshed
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(cls.SCHEMA)
+            conn.executemany(
+                "INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+                [("max_zoom", str(max_zoom)), ("margin", str(margin))])
+            conn.commit()
         finally:
-            cursor.close()
+            conn.close()
+
+        return cls(path, **kwargs)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = self._local.conn = _connect_read_only(sqlite3, self.path)
+
+        return conn
+
+    def _expanded_bounds(self, tile):
+        """Get a tile's bounds (in WGS84), expanded by `margin`."""
+        (left, bottom, right, top) = mercantile.xy_bounds(tile)
+        dx = (right - left) * self.margin
+        dy = (top - bottom) * self.margin
+
+        (west, south) = mercantile.lnglat(left - dx, bottom - dy)
+        (east, north) = mercantile.lnglat(right + dx, top + dy)
+
+        return (max(west, -180), max(south, -90), min(east, 180),
+                min(north, 90))
+
+    def _tile_range(self, bounds, zoom):
+        """Get the range of tiles at `zoom` that intersect `bounds`."""
+        (left, bottom, right, top) = bounds
+        limit = 2**zoom - 1
+        ul = mercantile.tile(max(left, -180), min(top, 85.0511), zoom)
+        lr = mercantile.tile(
+            min(right, 180) - 1e-9, max(bottom, -85.0511) + 1e-9, zoom)
+
+        return (max(ul.x, 0), max(ul.y, 0), min(lr.x, limit),
+                min(lr.y, limit))
+
+    def refresh(self,
+                fetch,
+                bounds=(-180, -85.0511, 180, 85.0511),
+                min_zoom=0,
+                max_zoom=None):
+        """
+        Rebuild entries for tiles (between `min_zoom` and `max_zoom`) that
+        intersect `bounds` (in WGS84), e.g. the area covered by footprints
+        that changed; by default, everything is rebuilt.
+
+        `fetch(bounds, min_zoom, max_zoom)` (e.g. a PostGISFootprints)
+        provides footprints. Only tiles intersecting a footprint are
+        visited. The index is updated in a single transaction.
+        """
+        max_zoom = self.max_zoom if max_zoom is None else max_zoom
+        # digest -> footprint id
+        footprint_ids = {}
+        # digest -> list id
+        ids = {}
+        count = 0
+
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            cursor = conn.cursor()
+
+            try:
+                for zoom in range(min_zoom, max_zoom + 1):
+                    (min_x, min_y, max_x, max_y) = self._tile_range(
+                        bounds, zoom)
+                    (west, _, _, north) = mercantile.bounds(
+                        min_x, min_y, zoom)
+                    (_, south, east, _) = mercantile.bounds(
+                        max_x, max_y, zoom)
+                    # Web Mercator tiles are square, so a tile is never
+                    # taller than it is wide in degrees
+                    pad = 360. / 2**zoom * self.margin
+                    catalog = MemoryCatalog(max_zoom_inclusive=True)
+                    tiles = set()
+
+                    for (geometry, attributes) in fetch(
+                        (max(west - pad, -180), max(south - pad, -90),
+                         min(east + pad, 180), min(north + pad, 90)),
+                            zoom, zoom):
+                        catalog.add_source(geometry, attributes)
+
+                        (minx, miny, maxx, maxy) = geometry.bounds
+                        (x0, y0, x1, y1) = self._tile_range(
+                            (minx - pad, miny - pad, maxx + pad, maxy + pad),
+                            zoom)
+
+                        tiles.update((x, y)
+                                     for x in range(
+                                         max(x0, min_x), min(x1, max_x) + 1)
+                                     for y in range(
+                                         max(y0, min_y), min(y1, max_y) + 1))
+
+                    cursor.execute("""
+DELETE FROM tiles
+WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?
+                    """, (zoom, min_x, max_x, min_y, max_y))
+
+                    resolution = (2 * np.pi * 6378137 / 256) / 2**zoom
+                    rows = []
+
+                    for (x, y) in sorted(tiles):
+                        sources = catalog.get_sources(
+                            Bounds(
+                                self._expanded_bounds(
+                                    mercantile.Tile(x, y, zoom)), WGS84_CRS),
+                            (resolution, resolution))
+
+                        if not sources:
+                            continue
+
+                        digests = [
+                            self._footprint(cursor, source, footprint_ids)
+                            for source in sources
+                        ]
+                        digest = hashlib.sha1(
+                            ",".join(digests).encode("utf-8")).hexdigest()
+
+                        if digest not in ids:
+                            cursor.execute("""
+INSERT OR IGNORE INTO source_lists (digest) VALUES (?)
+                            """, (digest, ))
+                            cursor.execute(
+                                "SELECT id FROM source_lists WHERE digest = ?",
+                                (digest, ))
+                            ids[digest] = cursor.fetchone()[0]
+                            # lists are immutable, so an existing list's
+                            # footprints are already in place
+                            cursor.executemany("""
+INSERT OR IGNORE INTO list_footprints (list_id, position, footprint_id)
+VALUES (?, ?, ?)
+                            """, [(ids[digest], position,
+                                   footprint_ids[footprint])
+                                  for (position, footprint)
+                                  in enumerate(digests)])
+
+                        rows.append((zoom, x, y, ids[digest]))
+
+                    cursor.executemany(
+                        "INSERT INTO tiles (z, x, y, list_id) "
+                        "VALUES (?, ?, ?, ?)", rows)
+                    count += len(rows)
+
+                    LOG.info("Indexed %d tiles at zoom %d (%d source lists)",
+                             len(rows), zoom, len(ids))
+
+                cursor.execute("""
+DELETE FROM source_lists
+WHERE id NOT IN (SELECT DISTINCT list_id FROM tiles)
+                """)
+                cursor.execute("""
+DELETE FROM list_footprints
+WHERE list_id NOT IN (SELECT id FROM source_lists)
+                """)
+                cursor.execute("""
+DELETE FROM footprints
+WHERE id NOT IN (SELECT DISTINCT footprint_id FROM list_footprints)
+                """)
+
+                conn.commit()
+
+                # copy the changes into the database file, so that it's
+                # complete on its own (e.g. when opened immutable)
+                cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except Exception as e:
+                conn.rollback()
+                LOG.warn(e)
+                raise e
+            finally:
+                cursor.close()
+                conn.close()
+
+        return count
+
+    @staticmethod
+    def _footprint(cursor, source, footprint_ids):
+        """
+        Store a source's footprint (unless it's already been stored), noting
+        its id in `footprint_ids`. Returns its digest.
+        """
+        data = json.dumps(source._asdict(), sort_keys=True)
+        digest = hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+        if digest not in footprint_ids:
+            cursor.execute("""
+INSERT OR IGNORE INTO footprints (digest, source) VALUES (?, ?)
+            """, (digest, data))
+            cursor.execute("SELECT id FROM footprints WHERE digest = ?",
+                           (digest, ))
+            footprint_ids[digest] = cursor.fetchone()[0]
+
+        return digest
+
+    def _sources(self, tile):
+        # a single query, so that the list can't change under it
+        rows = self._connection().execute("""
+SELECT source_lists.digest, footprints.source
+FROM tiles
+JOIN source_lists ON source_lists.id = tiles.list_id
+JOIN list_footprints ON list_footprints.list_id = tiles.list_id
+JOIN footprints ON footprints.id = list_footprints.footprint_id
+WHERE z = ? AND x = ? AND y = ?
+ORDER BY position
+        """, (tile.z, tile.x, tile.y)).fetchall()
+
+        if not rows:
+            return []
+
+        digest = rows[0][0]
+
+        with self._lists_lock:
+            sources = self._lists.get(digest)
+
+        if sources is None:
+            sources = [Source(**json.loads(data)) for (_, data) in rows]
+
+            with self._lists_lock:
+                self._lists[digest] = sources
+
+        return sources
+
+    def get_sources(self, bounds, resolution, **kwargs):
+        zoom = get_zoom(max(resolution))
+
+        if not kwargs and zoom <= self.max_zoom:
+            if bounds.crs == WGS84_CRS:
+                (left, bottom, right, top) = bounds.bounds
+            else:
+                (left, bottom, right, top) = warp.transform_bounds(
+                    bounds.crs, WGS84_CRS, *bounds.bounds)
+
+            if max(abs(bottom), abs(top)) <= 85.0511:
+                tile = mercantile.tile((left + right) / 2,
+                                       (bottom + top) / 2, zoom)
+                (west, south, east, north) = self._expanded_bounds(tile)
+
+                # allow for reprojection error
+                eps = 1e-9
+
+                if (left >= west - eps and bottom >= south - eps
+                        and right <= east + eps and top <= north + eps):
+                    return self._sources(tile)
+
+        if self.catalog is None:
+            return []
+
+        return self.catalog.get_sources(bounds, resolution, **kwargs)
+
+
+class SnapshotCatalog(Catalog):
+    """
+    A read-only catalog that answers lookups from a footprint snapshot file
+    (see tilezen.snapshot and `write`), e.g. one shipped alongside a worker,
+    so no network I/O is needed. The file is memory-mapped, so opening it is
+    cheap and its pages are shared between processes.
+
+    Sources are selected and ordered as a MemoryCatalog would (including for
+    ranges of zooms, given `min_zoom` and `max_zoom`). Each footprint's
+    attributes are stored as a JSON string.
+    """
+
+    def __init__(self, path, max_zoom_inclusive=True):
+        # snapshots are exported from PostGIS, which treats max_zoom as
+        # inclusive
+        self.max_zoom_inclusive = max_zoom_inclusive
+        self._snapshot = snapshot.Snapshot(path)
+
+        # (empty snapshots used to be written with no strings per item)
+        if self._snapshot.count and self._snapshot.strings_per_item != 1:
+            raise Exception(
+                "{} has an outdated layout; export it again".format(path))
+
+    @staticmethod
+    def write(path, footprints, node_size=16):
+        """
+        Write a snapshot of `footprints` ((geometry, attributes) pairs, as
+        provided by PostGISFootprints or SpatialiteCatalog.footprints) to
+        `path`. Returns the number of footprints written.
+        """
+        boxes = []
+        rows = []
+        geometries = []
+        strings = []
+
+        for (geometry, attributes) in footprints:
+            centroid = geometry.centroid
+
+            boxes.append(geometry.bounds)
+            rows.append((attributes['min_zoom'], attributes['max_zoom'],
+                         attributes['priority'], attributes['resolution'],
+                         centroid.x, centroid.y))
+            geometries.append(geometry.wkb)
+            # datetimes are written as ISO 8601
+            strings.append(
+                json.dumps(
+                    attributes, default=lambda value: value.isoformat()))
+
+        snapshot.write(
+            path,
+            boxes,
+            np.array(rows, dtype=np.float64).reshape(
+                -1, len(MemoryCatalog.COLUMNS)),
+            geometries,
+            strings,
+            strings_per_item=1,
+            node_size=node_size)
+
+        return len(rows)
+
+    def get_sources(self, bounds, resolution, min_zoom=None, max_zoom=None):
+        from shapely import wkb
+        from shapely.geometry import box
+
+        bounds, bounds_crs = bounds
+
+        zooms = _zoom_range(resolution, min_zoom, max_zoom)
+        ((left, right), (bottom, top)) = warp.transform(
+            bounds_crs, WGS84_CRS, bounds[::2], bounds[1::2])
+        bounds_geom = box(left, bottom, right, top)
+
+        return _select_sources(
+            self._snapshot.search(bounds_geom.bounds), self._snapshot.columns,
+            zooms, bounds_geom,
+            lambda i: wkb.loads(self._snapshot.geometry(i)),
+            lambda i: json.loads(self._snapshot.string(i)),
+            self.max_zoom_inclusive)
 
 
 if __name__ == "__main__":
@@ -318,9 +1506,9 @@ if __name__ == "__main__":
         features = json.load(f)
 
     cat = SpatialiteCatalog()
-    for f in features["features"]:
-        s = Source(geom=f["geometry"], **f["properties"])
-        cat.add_source(s)
+    cat.add_sources(
+        Source(geom=f["geometry"], **f["properties"])
+        for f in features["features"])
 
     # z14
     bounds = Bounds((13.0517578125, 60.46805012087461, 13.07373046875,
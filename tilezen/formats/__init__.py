@@ -1,6 +1,8 @@
 # coding=utf-8
 from __future__ import absolute_import
 
-from . import skadi
+from . import geotiff, png, skadi
 
+GeoTIFF = geotiff.format
+PNG = png.format
 Skadi = skadi.format
@@ -0,0 +1,145 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import os
+
+import numpy as np
+
+from marblecutter import _nodata, get_resolution_in_meters
+from rasterio import transform
+from rasterio.io import MemoryFile
+
+CONTENT_TYPE = "image/tiff"
+
+# (creation option for the compression level, default level)
+COMPRESSION_LEVELS = {
+    "deflate": ("zlevel", 6),
+    "zstd": ("zstd_level", 9),
+}
+MANTISSA_BITS = {
+    np.dtype(np.float32): (np.uint32, 23),
+    np.dtype(np.float64): (np.uint64, 52),
+}
+
+
+def _truncate(data, precision):
+    """
+    Round the mantissas of a float masked array so that each value is within
+    `precision` / 2 of the original, zeroing the low bits so that they
+    compress well. The number of bits kept is chosen based on the largest
+    magnitude present.
+    """
+    values = np.ma.getdata(data).copy()
+    finite = np.isfinite(values) & ~np.ma.getmaskarray(data)
+
+    if not finite.any():
+        return data
+
+    magnitude = np.abs(values[finite]).max()
+
+    if magnitude == 0:
+        return data
+
+    (uint, mantissa_bits) = MANTISSA_BITS[values.dtype]
+
+    # values are in [2**(exponent - 1), 2**exponent), so keeping n mantissa
+    # bits leaves a spacing of 2**(exponent - 1 - n) between them
+    (_, exponent) = np.frexp(magnitude)
+    keep = int(np.ceil(exponent - 1 - np.log2(precision)))
+    drop = mantissa_bits - min(max(keep, 0), mantissa_bits)
+
+    if drop > 0:
+        bits = values.view(uint)
+        # round half up; carries into the exponent are still correct
+        rounded = (bits + uint(1 << (drop - 1))) & ~uint((1 << drop) - 1)
+        bits[finite] = rounded[finite]
+
+    return np.ma.masked_array(
+        values, mask=np.ma.getmaskarray(data), fill_value=data.fill_value)
+
+
+def format(area_or_point="Area",
+           compress="deflate",
+           level=None,
+           precision=None):
+    """
+    marblecutter's GeoTIFF format, extended with ZSTD compression (ZSTD
+    requires GDAL 2.3+) and compression levels.
+
+    If `precision` (in data units, e.g. 0.1 m) is provided, float data is
+    truncated to it (lossily), which makes it considerably more compressible.
+    """
+    compress = compress.lower()
+
+    if compress not in COMPRESSION_LEVELS:
+        raise Exception("Unsupported compression: {}".format(compress))
+
+    (level_option, default_level) = COMPRESSION_LEVELS[compress]
+
+    if level is None:
+        level = default_level
+
+    def _format(pixels, data_format):
+        data, (data_bounds, data_crs) = pixels
+        if data_format != "raw":
+            raise Exception("raw data is required")
+
+        (count, height, width) = data.shape
+
+        if count == 1:
+            resolution = get_resolution_in_meters(pixels.bounds,
+                                                  (height, width))
+
+            # downsample to int16 if ground resolution is more than 10 meters
+            # (at the equator), as marblecutter does
+            if resolution[0] > 10 and resolution[1] > 10:
+                data = data.astype(np.int16)
+                data.fill_value = _nodata(data.dtype)
+
+        if np.issubdtype(data.dtype, np.floating):
+            predictor = 3
+
+            if precision:
+                data = _truncate(data, precision)
+        else:
+            predictor = 2
+
+        meta = {
+            "blockxsize": 512 if width >= 512 else width,
+            "blockysize": 512 if height >= 512 else height,
+            "compress": compress,
+            level_option: level,
+            "count": count,
+            "crs": data_crs,
+            "dtype": data.dtype,
+            "driver": "GTiff",
+            "nodata": data.fill_value if data.dtype != np.uint8 else None,
+            "predictor": predictor,
+            "height": height,
+            "width": width,
+            "tiled": width >= 512 and height >= 512,
+            "transform": transform.from_bounds(
+                *data_bounds,
+                width=width,
+                height=height),
+        }
+
+        with MemoryFile() as memfile:
+            with memfile.open(**meta) as dataset:
+                dataset.update_tags(AREA_OR_POINT=area_or_point)
+                dataset.write(data.filled())
+
+            return (CONTENT_TYPE, memfile.read())
+
+    return _format
+
+
+def from_env(prefix="GEOTIFF", **kwargs):
+    """
+    Create a GeoTIFF format configured by the `<prefix>_COMPRESS` and
+    `<prefix>_PRECISION` environment variables.
+    """
+    return format(
+        compress=os.environ.get(prefix + "_COMPRESS", "deflate"),
+        precision=float(os.environ.get(prefix + "_PRECISION", 0)) or None,
+        **kwargs)
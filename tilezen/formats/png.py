@@ -0,0 +1,169 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+from marblecutter import _isimage
+from marblecutter.stats import Timer
+
+CONTENT_TYPE = "image/png"
+COLOR_TYPES = {"RGB": 2, "RGBA": 6}
+FILTERS = ["none", "sub", "up", "average", "paeth"]
+LOG = logging.getLogger(__name__)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Python 2's zlib module doesn't expose Z_RLE
+Z_RLE = getattr(zlib, "Z_RLE", 3)
+
+# terrain changes smoothly, so predicting each sample from its neighbors
+# leaves mostly small residuals; "adaptive" picks the best filter per row (as
+# libpng does) at the cost of trying them all
+PROFILES = {
+    "fast": {
+        "compresslevel": 1,
+        "filter": "sub",
+        "strategy": Z_RLE,
+    },
+    "balanced": {
+        "compresslevel": 6,
+        "filter": "paeth",
+        "strategy": zlib.Z_DEFAULT_STRATEGY,
+    },
+    "small": {
+        "compresslevel": 9,
+        "filter": "adaptive",
+        "strategy": zlib.Z_DEFAULT_STRATEGY,
+    },
+}
+
+
+def _chunk(type, data):
+    return (struct.pack(">L", len(data)) + type + data + struct.pack(
+        ">L", zlib.crc32(type + data) & 0xffffffff))
+
+
+def _neighbors(data):
+    """
+    Reshape an (H, W, C) uint8 array into scanlines, along with the bytes
+    each filter predicts from: a, the corresponding byte in the pixel to the
+    left; b, above; and c, above and to the left (all 0 beyond the image).
+    """
+    (height, width, count) = data.shape
+    x = data.reshape(height, width * count)
+
+    a = np.zeros_like(x)
+    a[:, count:] = x[:, :-count]
+    b = np.zeros_like(x)
+    b[1:] = x[:-1]
+    c = np.zeros_like(x)
+    c[1:] = a[:-1]
+
+    return x, a, b, c
+
+
+def _filter(filter, x, a, b, c):
+    """
+    Apply a PNG filter. Filters operate on bytes, so uint8 arithmetic wraps
+    around as the spec requires.
+    """
+    if filter == "none":
+        return x
+    if filter == "sub":
+        return x - a
+    if filter == "up":
+        return x - b
+    if filter == "average":
+        return x - ((a.astype(np.uint16) + b) >> 1).astype(np.uint8)
+
+    a, b, c = (v.astype(np.int16) for v in (a, b, c))
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+    predictor = np.where((pa <= pb) & (pa <= pc), a,
+                         np.where(pb <= pc, b, c)).astype(np.uint8)
+
+    return x - predictor
+
+
+def _scanlines(data, filter):
+    """Filter an (H, W, C) uint8 array into PNG scanlines."""
+    height = data.shape[0]
+    neighbors = _neighbors(data)
+
+    if filter == "adaptive":
+        filtered = np.stack([_filter(f, *neighbors) for f in FILTERS])
+
+        # minimum sum of absolute differences, treating bytes as signed
+        scores = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=2)
+        types = scores.argmin(axis=0).astype(np.uint8)
+        rows = filtered[types, np.arange(height)]
+    else:
+        types = np.full(height, FILTERS.index(filter), dtype=np.uint8)
+        rows = _filter(filter, *neighbors)
+
+    return np.hstack((types[:, np.newaxis], rows))
+
+
+def format(profile="balanced",
+           compresslevel=None,
+           filter=None,
+           strategy=None,
+           drop_opaque_alpha=True):
+    """
+    Encode PNGs with zlib settings from one of `PROFILES` (optionally
+    overridden). Fully opaque RGBA images are written as RGB.
+    """
+    options = PROFILES[profile].copy()
+    if compresslevel is not None:
+        options["compresslevel"] = compresslevel
+    if filter is not None:
+        options["filter"] = filter
+    if strategy is not None:
+        options["strategy"] = strategy
+
+    if options["filter"] not in FILTERS + ["adaptive"]:
+        raise Exception("Unsupported PNG filter: {}".format(
+            options["filter"]))
+
+    def _format(pixels, data_format):
+        if not _isimage(data_format):
+            raise Exception("Must be an image format")
+
+        data_format = data_format.upper()
+
+        with Timer() as t:
+            data = np.ma.getdata(pixels.data)
+
+            if (drop_opaque_alpha and data_format == "RGBA"
+                    and (data[:, :, 3] == 255).all()):
+                data = data[:, :, :3]
+                data_format = "RGB"
+
+            (height, width, _) = data.shape
+
+            compressor = zlib.compressobj(options["compresslevel"],
+                                          zlib.DEFLATED, zlib.MAX_WBITS,
+                                          zlib.DEF_MEM_LEVEL,
+                                          options["strategy"])
+            idat = compressor.compress(
+                _scanlines(data, options["filter"]).tobytes())
+            idat += compressor.flush()
+
+            out = b"".join([
+                PNG_SIGNATURE,
+                _chunk(b"IHDR",
+                       struct.pack(">LLBBBBB", width, height, 8,
+                                   COLOR_TYPES[data_format], 0, 0, 0)),
+                _chunk(b"IDAT", idat),
+                _chunk(b"IEND", b""),
+            ])
+
+        LOG.debug("Encoded %dx%d %s PNG (%s profile) in %0.3fs: %d bytes",
+                  width, height, data_format, profile, t.elapsed, len(out))
+
+        return (CONTENT_TYPE, out)
+
+    return _format
@@ -1,59 +1,43 @@
 # coding=utf-8
 from __future__ import absolute_import
 
-from gzip import GzipFile
-from io import BytesIO
-
 import numpy as np
 
 from marblecutter import _nodata
-from rasterio import transform
-from rasterio.io import MemoryFile
 
+from .utils import gzip_blocks
+
+BLOCK_ROWS = 256
 CONTENT_TYPE = "application/gzip"
+# HGT is headerless, big-endian int16
+HGT_DTYPE = np.dtype(">i2")
+
+
+def _blocks(data, rows=BLOCK_ROWS):
+    """
+    Encode a (count, height, width) masked array as HGT, `rows` rows at a
+    time, so that only one block is ever converted in memory.
+    """
+    nodata = _nodata(np.int16)
+
+    for band in data:
+        for row in range(0, band.shape[0], rows):
+            block = band[row:row + rows]
+            out = np.ma.getdata(block).astype(HGT_DTYPE)
+            out[np.ma.getmaskarray(block)] = nodata
+
+            yield out.tobytes()
 
 
-def format():
+def format(compresslevel=9, threads=1):
     def _format(pixels, data_format):
-        data, (data_bounds, data_crs) = pixels
+        data, _ = pixels
         if data_format is not "raw":
             raise Exception("raw data is required")
 
-        (count, height, width) = data.shape
-
-        # HGT only supports byte, int16, and uint16
-        data = data.astype(np.int16)
-        data.fill_value = _nodata(np.int16)
-
-        meta = {
-            "count": count,
-            "crs": data_crs,
-            "dtype": data.dtype,
-            "driver": "SRTMHGT",
-            "nodata": data.fill_value,
-            "height": height,
-            "width": width,
-            "transform": transform.from_bounds(
-                *data_bounds,
-                width=width,
-                height=height),
-        }
-
-        # GDAL's SRTMHGT driver requires that filenames be correct
-        (lon, lat) = map(int, map(round, data_bounds[:2]))
-        x = "W" if lon < 0 else "E"
-        y = "S" if lat < 0 else "N"
-        filename = "{}{}{}{}.hgt".format(y, abs(lat), x, abs(lon))
-        filename = "{}{:02d}{}{:03d}.hgt".format(y, abs(lat), x, abs(lon))
-
-        with MemoryFile(filename=filename) as memfile:
-            with memfile.open(**meta) as dataset:
-                dataset.write(data.filled())
-
-            out = BytesIO()
-            with GzipFile(mode='wb', fileobj=out) as f:
-                f.write(memfile.read())
-
-        return (CONTENT_TYPE, out.getvalue())
+        return (CONTENT_TYPE, b"".join(
+            gzip_blocks(
+                _blocks(data), compresslevel=compresslevel,
+                threads=threads)))
 
     return _format
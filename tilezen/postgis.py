@@ -0,0 +1,175 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+# database URL -> ConnectionPool
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class _Connection(object):
+    """A pooled connection and the statements prepared on it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.time()
+        self.prepared = set()
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of PostgreSQL connections.
+
+    Each thread checks out at most one connection at a time (nested
+    `connection()` blocks reuse it); threads wait when all `maxconn`
+    connections are in use. Connections are kept open once they're returned
+    (`minconn` are opened up front), so statements prepared on them stay
+    prepared; the most recently used is handed out first. Connections that
+    have been idle for more than `check_after` seconds are checked before
+    being handed out and replaced if they've gone away.
+    """
+
+    def __init__(self,
+                 database_url=os.getenv("DATABASE_URL"),
+                 minconn=1,
+                 maxconn=16,
+                 check_after=30):
+        if database_url is None:
+            raise Exception("Database URL must be provided.")
+
+        self.database_url = database_url
+        self.check_after = check_after
+        self._available = threading.BoundedSemaphore(maxconn)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # idle connections; checkouts are bounded by _available, so there
+        # are never more than maxconn
+        self._idle = deque(self._connect() for _ in range(minconn))
+
+    def _connect(self):
+        import psycopg2
+
+        return _Connection(psycopg2.connect(self.database_url))
+
+    def _healthy(self, conn):
+        import psycopg2
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+
+            return True
+        except psycopg2.Error as e:
+            LOG.warn("Discarding connection: %s", e)
+
+            return False
+
+    def _discard(self, entry):
+        import psycopg2
+
+        try:
+            entry.conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+
+            if entry is None:
+                return self._connect()
+
+            if entry.conn.closed or (
+                    time.time() - entry.last_used > self.check_after
+                    and not self._healthy(entry.conn)):
+                self._discard(entry)
+                continue
+
+            return entry
+
+    def _checkin(self, entry):
+        if entry.conn.closed:
+            return
+
+        entry.last_used = time.time()
+
+        with self._lock:
+            self._idle.append(entry)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the current thread. The transaction is
+        committed when the block exits normally and rolled back otherwise.
+        """
+        entry = getattr(self._local, "entry", None)
+
+        if entry is not None:
+            yield entry.conn
+            return
+
+        self._available.acquire()
+
+        try:
+            entry = self._checkout()
+            self._local.entry = entry
+            conn = entry.conn
+
+            try:
+                yield conn
+
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._local.entry = None
+                self._checkin(entry)
+        finally:
+            self._available.release()
+
+    def execute(self, cursor, name, query, params):
+        """
+        Execute `query` (with $1, $2, ... placeholders) as a server-side
+        prepared statement called `name`, preparing it the first time it's
+        used on each connection so that it's only parsed and planned once.
+        `cursor` must belong to the current thread's `connection()`.
+        """
+        entry = getattr(self._local, "entry", None)
+
+        if entry is None or entry.conn is not cursor.connection:
+            raise Exception("Cursor doesn't belong to a pooled connection")
+
+        if name not in entry.prepared:
+            cursor.execute("PREPARE {} AS {}".format(name, query))
+            entry.prepared.add(name)
+
+        cursor.execute("EXECUTE {} ({})".format(
+            name, ", ".join(["%s"] * len(params))), params)
+
+
+def get_pool(database_url=os.getenv("DATABASE_URL"), **kwargs):
+    """
+    Get the shared pool for `database_url`, creating it (with `kwargs`, or
+    POSTGIS_MIN_CONNECTIONS / POSTGIS_MAX_CONNECTIONS) if necessary.
+    """
+    with _POOLS_LOCK:
+        if database_url not in _POOLS:
+            kwargs.setdefault("minconn",
+                              int(os.getenv("POSTGIS_MIN_CONNECTIONS", 1)))
+            kwargs.setdefault("maxconn",
+                              int(os.getenv("POSTGIS_MAX_CONNECTIONS", 16)))
+
+            _POOLS[database_url] = ConnectionPool(database_url, **kwargs)
+
+        return _POOLS[database_url]
@@ -33,7 +33,7 @@ def _parse_skadi_tile(tile_name):
     return None
 
 
-def render_tile(tile, source_provider):
+def render_tile(tile, source_provider, format=SKADI_FORMAT):
     """Render a tile into gzipped HGT."""
     bounds = _bbox(*_parse_skadi_tile(tile))
 
@@ -43,4 +43,4 @@ def render_tile(tile, source_provider):
         SHAPE,
         SKADI_CRS,
         data_band_count=1,
-        format=SKADI_FORMAT)
+        format=format)
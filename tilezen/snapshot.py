@@ -0,0 +1,249 @@
+# coding=utf-8
+"""
+A read-only, memory-mappable file format for footprint catalogs.
+
+Items are sorted by the Hilbert index of their envelopes' centers and
+indexed by a packed static R-tree (as in flatbush): each node holds up to
+`node_size` children, and levels are stored leaves first, so the children of
+node `i` are nodes `i * node_size ...` in the level below. All sections are
+little-endian and 8-byte aligned, so they're read in place with no parsing:
+
+    header          magic, version, node size, item count, level count,
+                    column count, strings per item
+    level counts    uint32 per level, leaves first (padded to 8 bytes)
+    boxes           float64 (min x, min y, max x, max y) per node
+    columns         float64 per item and column (see `write`)
+    geometries      uint64 offsets (item count + 1) into the WKB blob
+    strings         uint64 offsets (string count + 1) into the string blob
+    WKB blob
+    string blob     UTF-8, `strings_per_item` per item
+"""
+from __future__ import absolute_import, division
+
+import mmap
+import os
+import struct
+
+import numpy as np
+
+HEADER = struct.Struct("<4sHHIIHH4x")
+MAGIC = b"TZFP"
+VERSION = 1
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def _spread(v):
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    return (v | (v << 1)) & 0x55555555
+
+
+def hilbert(x, y):
+    """
+    Get the Hilbert curve index of 16-bit integer coordinates (vectorized
+    over uint32 arrays; from "Fast Hilbert curve generation, sorting, and
+    range queries", http://threadlocalmutex.com/?p=126).
+    """
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    # (C and D aren't updated in place, since c and d refer to them)
+    for shift in (2, 4):
+        (a, b, c, d) = (A, B, C, D)
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ (a & (c >> shift)) ^ (b & (d >> shift))
+        D = D ^ (b & (c >> shift)) ^ ((a ^ b) & (d >> shift))
+
+    (a, b, c, d) = (A, B, C, D)
+    C = C ^ (a & (c >> 8)) ^ (b & (d >> 8))
+    D = D ^ (b & (c >> 8)) ^ ((a ^ b) & (d >> 8))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    return (_spread(i1) << 1) | _spread(i0)
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+
+    return value.encode("utf-8")
+
+
+def write(path,
+          boxes,
+          columns,
+          geometries,
+          strings,
+          strings_per_item=1,
+          node_size=16):
+    """
+    Write a snapshot of items with envelopes `boxes` ((N, 4) array), rows of
+    float `columns` ((N, M) array), WKB `geometries` and `strings`
+    (`strings_per_item` per item, in item order) to `path`.
+
+    The file is written alongside `path` and renamed into place, so readers
+    with the previous snapshot mapped are unaffected.
+    """
+    boxes = np.asarray(boxes, dtype="<f8").reshape(-1, 4)
+    columns = np.asarray(columns, dtype="<f8")
+    count = len(boxes)
+
+    if len(strings) != count * strings_per_item:
+        raise Exception("{} strings were provided for {} items".format(
+            len(strings), count))
+
+    # sort by the Hilbert index of envelope centers, scaled to the extent
+    if count:
+        centers = np.column_stack(((boxes[:, 0] + boxes[:, 2]) / 2,
+                                   (boxes[:, 1] + boxes[:, 3]) / 2))
+        (minimum, maximum) = (centers.min(axis=0), centers.max(axis=0))
+        scale = 0xFFFF / np.where(maximum > minimum, maximum - minimum, 1)
+        (x, y) = ((centers - minimum) * scale).astype(np.uint32).T
+        order = np.argsort(hilbert(x, y), kind="mergesort")
+    else:
+        order = np.arange(0)
+
+    # build levels up from the leaves, each node covering `node_size`
+    # children
+    levels = [boxes[order]]
+
+    while len(levels[-1]) > 1:
+        children = levels[-1]
+        starts = np.arange(0, len(children), node_size)
+        levels.append(
+            np.hstack((np.minimum.reduceat(children[:, :2], starts),
+                       np.maximum.reduceat(children[:, 2:], starts))))
+
+    geometries = [geometries[i] for i in order]
+    strings = [
+        _encode(strings[i * strings_per_item + j]) for i in order
+        for j in range(strings_per_item)
+    ]
+
+    level_counts = np.array([len(level) for level in levels], dtype="<u4")
+    geometry_offsets = np.cumsum([0] + [len(g) for g in geometries],
+                                 dtype="<u8")
+    string_offsets = np.cumsum([0] + [len(s) for s in strings], dtype="<u8")
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+    with open(tmp_path, "wb") as f:
+        f.write(
+            HEADER.pack(MAGIC, VERSION, node_size, count, len(levels),
+                        columns.shape[1], strings_per_item))
+        f.write(level_counts.tobytes())
+        f.write(b"\0" * (_align(level_counts.nbytes) - level_counts.nbytes))
+
+        for level in levels:
+            f.write(np.ascontiguousarray(level, dtype="<f8").tobytes())
+
+        f.write(np.ascontiguousarray(columns[order]).tobytes())
+        f.write(geometry_offsets.tobytes())
+        f.write(string_offsets.tobytes())
+
+        for geometry in geometries:
+            f.write(geometry)
+
+        for string in strings:
+            f.write(string)
+
+    os.rename(tmp_path, path)
+
+
+class Snapshot(object):
+    """A memory-mapped snapshot (see `write`)."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.node_size, self.count, levels, columns,
+         self.strings_per_item) = HEADER.unpack_from(self._mmap, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise Exception("Not a footprint snapshot: {}".format(path))
+
+        offset = HEADER.size
+        self._level_counts = np.frombuffer(
+            self._mmap, dtype="<u4", count=levels, offset=offset).tolist()
+        offset += _align(4 * levels)
+
+        # where each level starts in `boxes`
+        self._level_starts = np.cumsum([0] + self._level_counts).tolist()
+
+        (self.boxes, offset) = self._array(
+            "<f8", self._level_starts[-1] * 4, offset)
+        self.boxes = self.boxes.reshape(-1, 4)
+        (self.columns, offset) = self._array("<f8", self.count * columns,
+                                             offset)
+        self.columns = self.columns.reshape(self.count, columns)
+        (self._geometry_offsets, offset) = self._array(
+            "<u8", self.count + 1, offset)
+        (self._string_offsets, offset) = self._array(
+            "<u8", self.count * self.strings_per_item + 1, offset)
+
+        self._geometries_start = offset
+        self._strings_start = offset + int(self._geometry_offsets[-1])
+
+    def _array(self, dtype, count, offset):
+        array = np.frombuffer(
+            self._mmap, dtype=dtype, count=count, offset=offset)
+
+        return array, offset + array.nbytes
+
+    def close(self):
+        self._mmap.close()
+
+    def geometry(self, i):
+        """Get an item's geometry as WKB."""
+        start = self._geometries_start
+        return self._mmap[start + int(self._geometry_offsets[i]):
+                          start + int(self._geometry_offsets[i + 1])]
+
+    def string(self, i, j=0):
+        """Get an item's `j`th string."""
+        k = i * self.strings_per_item + j
+        start = self._strings_start
+        return self._mmap[start + int(self._string_offsets[k]):
+                          start + int(self._string_offsets[k + 1])].decode(
+                              "utf-8")
+
+    def search(self, bounds):
+        """
+        Find items whose envelopes intersect `bounds` (min x, min y, max x,
+        max y), returning their ids in ascending order.
+        """
+        (left, bottom, right, top) = bounds
+        # start from the root (the only node in the top level)
+        positions = np.arange(self._level_counts[-1])
+
+        for level in range(len(self._level_counts) - 1, -1, -1):
+            boxes = self.boxes[self._level_starts[level] + positions]
+            positions = positions[(boxes[:, 0] <= right)
+                                  & (boxes[:, 1] <= top)
+                                  & (boxes[:, 2] >= left)
+                                  & (boxes[:, 3] >= bottom)]
+
+            if level > 0:
+                children = (positions[:, np.newaxis] * self.node_size +
+                            np.arange(self.node_size)).ravel()
+                positions = children[children < self._level_counts[level - 1]]
+
+        return positions
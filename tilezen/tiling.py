@@ -0,0 +1,493 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import threading
+
+import mercantile
+import numpy as np
+
+from cachetools import LRUCache
+from marblecutter import (WEB_MERCATOR_CRS, NoDataAvailable, PixelCollection,
+                          tiling)
+from marblecutter.stats import Timer
+from marblecutter.transformations.utils import TransformationBase
+from marblecutter.utils import Bounds
+from mercantile import Tile
+from rasterio.warp import Resampling
+
+from .transformations.resample import downsample
+
+# (transformation, format, scale, shape, dtype, value) -> (content type, data)
+CONSTANT_TILES = LRUCache(maxsize=1024)
+CONSTANT_TILES_LOCK = threading.Lock()
+# header set on outputs rendered from constant (or empty) mosaics; "masked"
+# for empty tiles, otherwise the value(s)
+CONSTANT_HEADER = "X-Constant-Tile"
+
+
+class _Buffer(TransformationBase):
+    """
+    Expand rendered bounds by the largest buffer needed by any output, but
+    leave the buffer in place so that each output can crop what it needs.
+    """
+
+    def __init__(self, buffer):
+        TransformationBase.__init__(self)
+        self.buffer = buffer
+        self.offsets = None
+
+    def postprocess(self, pixels, data_format, offsets):
+        self.offsets = offsets
+
+        return pixels
+
+
+def _capture(pixels, data_format):
+    return None, pixels
+
+
+def _pad(data, widths):
+    """Pad a (count, height, width) masked array by repeating its edges."""
+    widths = [(0, 0)] + list(widths)
+
+    return np.ma.masked_array(
+        np.pad(np.ma.getdata(data), widths, "edge"),
+        mask=np.pad(np.ma.getmaskarray(data), widths, "edge"))
+
+
+def _buffered_bounds(tile, shape, buffer):
+    """Calculate the bounds of a tile's mosaic, including its buffer."""
+    bounds = mercantile.xy_bounds(tile)
+    (height, width) = shape
+    dx = (bounds[2] - bounds[0]) / (width - 2 * buffer)
+    dy = (bounds[3] - bounds[1]) / (height - 2 * buffer)
+
+    return Bounds((bounds[0] - buffer * dx, bounds[1] - buffer * dy,
+                   bounds[2] + buffer * dx, bounds[3] + buffer * dy),
+                  WEB_MERCATOR_CRS)
+
+
+def _output_buffers(outputs, scale):
+    # buffers are in output pixels; convert them to mosaic pixels
+    buffers = []
+    for (transformation, _, output_scale) in outputs:
+        if scale % output_scale:
+            raise Exception("Output scales must divide {}".format(scale))
+
+        if getattr(transformation, "collar", 0):
+            raise Exception("Collars are not supported")
+
+        buffer = getattr(transformation, "buffer", 0)
+        buffers.append(buffer * (scale // output_scale))
+
+    return buffers
+
+
+def _constant(data):
+    """
+    Describe a mosaic whose pixels are all masked ("masked") or all equal (a
+    tuple of per-band values). Returns None for anything else.
+    """
+    mask = np.ma.getmaskarray(data)
+
+    if mask.all():
+        return "masked"
+
+    if mask.any():
+        return None
+
+    values = np.ma.getdata(data).reshape(data.shape[0], -1)
+    first = values[:, :1]
+
+    if (values == first).all():
+        return tuple(first[:, 0].tolist())
+
+
+def _position_independent(transformation, value):
+    """
+    Whether a transformation produces the same output for a constant mosaic
+    wherever it is. Latitude adjustments scale elevations by row, so only
+    empty and 0 mosaics qualify unless the transformation says otherwise.
+    """
+    return (value == "masked" or not any(value)
+            or getattr(transformation, "position_independent", False))
+
+
+def render_mosaic(tile,
+                  catalog,
+                  scale,
+                  buffer,
+                  data_band_count=1,
+                  allow_empty=False):
+    """
+    Read and mosaic source data for a tile at `scale`, with `buffer` pixels
+    on every side. Where the buffer would extend beyond the edge of the world,
+    edge pixels are repeated instead.
+
+    If `allow_empty` is set, a fully masked mosaic is returned when no data is
+    available instead of raising NoDataAvailable.
+
+    Returns (headers, pixels).
+    """
+    transformation = _Buffer(buffer)
+
+    try:
+        (headers, pixels) = tiling.render_tile(
+            tile,
+            catalog,
+            format=_capture,
+            transformation=transformation,
+            scale=scale,
+            data_band_count=data_band_count)
+    except NoDataAvailable:
+        if not allow_empty:
+            raise
+
+        (height, width) = (np.array(tiling.TILE_SHAPE) * scale +
+                           2 * buffer).tolist()
+        shape = (data_band_count, height, width)
+        # zero-filled, since empty outputs are cached by (masked) value
+        data = np.ma.masked_array(
+            np.zeros(shape, dtype=np.float32),
+            mask=np.ones(shape, dtype=bool))
+
+        return {}, PixelCollection(
+            data, _buffered_bounds(tile, data.shape[1:], buffer))
+
+    (left, bottom, right, top) = transformation.offsets
+    data = pixels.data
+
+    if (left, bottom, right, top) != (buffer, ) * 4:
+        data = _pad(data, [(buffer - top, buffer - bottom),
+                           (buffer - left, buffer - right)])
+
+    return headers, PixelCollection(
+        data, _buffered_bounds(tile, data.shape[1:], buffer))
+
+
+def merge_children(tile,
+                   children,
+                   buffer,
+                   resampling=Resampling.average):
+    """
+    Build a tile's mosaic (with `buffer` pixels on every side) by downsampling
+    those of its children. `children` is a dict of tile -> pixels (each with
+    `buffer` pixels on every side, of which only the cores are used) that
+    includes the tile's children and, to fill its buffer, their neighbors.
+    Missing tiles (or tiles without data) are treated as masked; beyond the
+    edge of the world, edge pixels are repeated instead. Returns None if none
+    of the tile's children have data.
+    """
+    children = {
+        child: pixels
+        for child, pixels in children.items() if pixels is not None
+    }
+
+    if not any(child in children for child in mercantile.children(tile)):
+        return None
+
+    first = next(iter(children.values())).data
+    (count, height, _) = first.shape
+    size = height - 2 * buffer
+    # the 4x4 block of children centered on the tile
+    shape = (count, 4 * size, 4 * size)
+    (x, y) = (2 * tile.x - 1, 2 * tile.y - 1)
+
+    canvas = np.ma.masked_array(
+        np.zeros(shape, dtype=first.dtype), mask=np.ones(shape, dtype=bool))
+
+    for child, pixels in children.items():
+        (row, col) = ((child.y - y) * size, (child.x - x) * size)
+
+        if 0 <= row < shape[1] and 0 <= col < shape[2]:
+            canvas[:, row:row + size, col:col + size] = \
+                pixels.data[:, buffer:buffer + size, buffer:buffer + size]
+
+    # keep the children and the 2 * buffer pixels around them
+    margin = size - 2 * buffer
+    data = downsample(
+        canvas[:, margin:-margin or None, margin:-margin or None],
+        2,
+        resampling=resampling)
+
+    limit = 2**tile.z - 1
+    (top, bottom, left, right) = [
+        buffer if edge else 0
+        for edge in (tile.y == 0, tile.y == limit, tile.x == 0,
+                     tile.x == limit)
+    ]
+
+    if top or bottom or left or right:
+        (height, width) = data.shape[1:]
+        data = _pad(data[:, top:height - bottom, left:width - right],
+                    [(top, bottom), (left, right)])
+
+    return PixelCollection(data, _buffered_bounds(tile, data.shape[1:],
+                                                  buffer))
+
+
+def mosaic_sources(tile, catalog, scale, buffer):
+    """The URLs of the sources that `render_mosaic` would use for a tile."""
+    (height, width) = (np.array(tiling.TILE_SHAPE) * scale +
+                       2 * buffer).tolist()
+    bounds = _buffered_bounds(tile, (height, width), buffer)
+    (left, bottom, right, top) = bounds.bounds
+
+    return set(source[0]
+               for source in catalog.get_sources(bounds, (
+                   (right - left) / width, (top - bottom) / height)))
+
+
+def encode_outputs(pixels, buffer, outputs, scale, headers=None):
+    """
+    Transform and format a mosaic (with `buffer` pixels on every side, at
+    `scale`) into each of `outputs`, a list of (transformation, format, scale)
+    tuples.
+
+    Constant and empty mosaics are flagged with CONSTANT_HEADER and, where
+    the output doesn't depend on the tile's location (see
+    `_position_independent`) and isn't georeferenced, encoded once and
+    cached.
+
+    Returns a list of (headers, data) tuples, in the same order as `outputs`.
+    """
+    headers = headers or {}
+    results = []
+    value = _constant(pixels.data)
+
+    if value is not None:
+        headers = headers.copy()
+        headers[CONSTANT_HEADER] = (value if value == "masked" else
+                                    ", ".join(map(str, value)))
+
+    for ((transformation, format, output_scale), output_buffer) in zip(
+            outputs, _output_buffers(outputs, scale)):
+        factor = scale // output_scale
+        stats = []
+
+        with Timer() as t:
+            # drop the part of the mosaic's buffer this output doesn't need
+            crop = buffer - output_buffer
+            data, (bounds, crs) = pixels[:2]
+            (_, height, width) = data.shape
+            dx = (bounds[2] - bounds[0]) / width
+            dy = (bounds[3] - bounds[1]) / height
+
+            data = data[:, crop:height - crop, crop:width - crop]
+
+            if factor > 1:
+                data = downsample(data, factor)
+
+            output_pixels = PixelCollection(
+                data,
+                Bounds((bounds[0] + crop * dx, bounds[1] + crop * dy,
+                        bounds[2] - crop * dx, bounds[3] - crop * dy), crs))
+
+        stats.append(("crop", t.elapsed))
+
+        key = None
+        if value is not None and _position_independent(transformation, value):
+            key = (transformation, format, output_scale, data.shape,
+                   data.dtype, value)
+
+            with CONSTANT_TILES_LOCK:
+                cached = CONSTANT_TILES.get(key)
+
+            if cached is not None:
+                (content_type, formatted) = cached
+                output_headers = headers.copy()
+                output_headers["Content-Type"] = content_type
+                results.append((output_headers, formatted))
+                continue
+
+        data_format = "raw"
+
+        if transformation:
+            with Timer() as t:
+                output_pixels, data_format = transformation.transform(
+                    output_pixels)
+            stats.append(("transform", t.elapsed))
+
+            with Timer() as t:
+                output_pixels = transformation.postprocess(
+                    output_pixels, data_format,
+                    [output_buffer // factor] * 4)
+            stats.append(("postprocess", t.elapsed))
+
+        with Timer() as t:
+            (content_type, formatted) = format(output_pixels, data_format)
+        stats.append(("format", t.elapsed))
+
+        # GeoTIFFs are georeferenced, so they differ wherever they are
+        if key is not None and content_type != "image/tiff":
+            with CONSTANT_TILES_LOCK:
+                CONSTANT_TILES[key] = (content_type, formatted)
+
+        output_headers = headers.copy()
+        output_headers["Content-Type"] = content_type
+
+        if "X-Timers" in headers:
+            output_headers["X-Timers"] = ", ".join(
+                [headers["X-Timers"]] +
+                ["{}: {:0.2f}".format(*s) for s in stats])
+
+        results.append((output_headers, formatted))
+
+    return results
+
+
+def mosaic_buffer(outputs, scale):
+    """The buffer (in mosaic pixels) needed to produce all of `outputs`."""
+    return max(_output_buffers(outputs, scale))
+
+
+def mosaic_groups(tile, catalog, outputs, scale, buffer, size=1):
+    """
+    Group `outputs` (a list of (transformation, format, scale) tuples) by the
+    sources they'd be rendered from, since a mosaic at a larger scale may
+    select sources from a higher zoom than an output at a smaller one would.
+    The first group holds the outputs that can be produced from a mosaic of
+    `size` x `size` tiles at `scale` with `buffer`; each remaining group needs
+    a mosaic of its own.
+
+    Returns a list of lists of indexes into `outputs`.
+    """
+    sources = {}
+
+    def sources_at(output_scale):
+        if output_scale not in sources:
+            sources[output_scale] = mosaic_sources(
+                tile, catalog, output_scale * size,
+                -(-buffer * output_scale // scale))
+
+        return sources[output_scale]
+
+    groups = [(scale, [])]
+
+    for (index, (_, _, output_scale)) in enumerate(outputs):
+        for (group_scale, indexes) in groups:
+            if (output_scale == group_scale or
+                    sources_at(output_scale) == sources_at(group_scale)):
+                indexes.append(index)
+                break
+        else:
+            groups.append((output_scale, [index]))
+
+    return [indexes for (_, indexes) in groups]
+
+
+def _grouped_mosaics(tile, catalog, outputs, size, data_band_count,
+                     allow_empty):
+    """
+    Render a mosaic for each of `mosaic_groups`, yielding (indexes, headers,
+    pixels, buffer, scale) tuples.
+    """
+    scale = max(s for (_, _, s) in outputs)
+    buffer = mosaic_buffer(outputs, scale)
+
+    for indexes in mosaic_groups(tile, catalog, outputs, scale, buffer,
+                                 size=size):
+        group = [outputs[i] for i in indexes]
+        group_scale = max(s for (_, _, s) in group)
+        group_buffer = mosaic_buffer(group, group_scale)
+
+        (headers, pixels) = render_mosaic(
+            tile,
+            catalog,
+            group_scale * size,
+            group_buffer,
+            data_band_count=data_band_count,
+            allow_empty=allow_empty)
+
+        yield (indexes, headers, pixels, group_buffer, group_scale)
+
+
+def render_tile_outputs(tile,
+                        catalog,
+                        outputs,
+                        data_band_count=1,
+                        allow_empty=True):
+    """
+    Render a tile into several outputs while reading and mosaicking source
+    data once. Tiles without data are rendered (and flagged) as empty unless
+    `allow_empty` is False, in which case NoDataAvailable is raised.
+
+    `outputs` is a list of (transformation, format, scale) tuples. Sources are
+    mosaicked at the largest scale with the largest buffer required; each
+    output is then cropped to its own buffer and averaged down to its own
+    scale before being transformed and formatted. Outputs whose scales select
+    different sources (see `mosaic_groups`) get mosaics of their own.
+
+    Returns a list of (headers, data) tuples, in the same order as `outputs`.
+    """
+    results = [None] * len(outputs)
+
+    for (indexes, headers, pixels, buffer, scale) in _grouped_mosaics(
+            tile, catalog, outputs, 1, data_band_count, allow_empty):
+        for (index, result) in zip(indexes, encode_outputs(
+                pixels, buffer, [outputs[i] for i in indexes], scale,
+                headers=headers)):
+            results[index] = result
+
+    return results
+
+
+def metatile_for(tile, size):
+    """
+    Find the tile whose bounds cover the `size` x `size` metatile containing
+    `tile`, and the metatile's effective size (smaller at low zooms).
+    """
+    levels = min(size.bit_length() - 1, tile.z)
+
+    if 2**levels != min(size, 2**tile.z):
+        raise Exception("Metatile sizes must be powers of 2")
+
+    return Tile(tile.x >> levels, tile.y >> levels, tile.z - levels), \
+        2**levels
+
+
+def render_metatile(meta,
+                    catalog,
+                    outputs,
+                    size,
+                    data_band_count=1,
+                    allow_empty=True):
+    """
+    Render the `size` x `size` tiles beneath `meta` (`size` must be a power
+    of 2) into `outputs` from a single mosaic (per group of outputs, see
+    `mosaic_groups`), amortizing catalog queries, source reads and buffers
+    across all of them. If `allow_empty` is False,
+    NoDataAvailable is raised when the metatile has no data.
+
+    Returns a list of (tile, [(headers, data), ...]) tuples.
+    """
+    levels = size.bit_length() - 1
+    tiles = [
+        Tile(meta.x * size + col, meta.y * size + row, meta.z + levels)
+        for row in range(size) for col in range(size)
+    ]
+    results = [[None] * len(outputs) for _ in tiles]
+
+    for (indexes, headers, pixels, buffer, scale) in _grouped_mosaics(
+            meta, catalog, outputs, size, data_band_count, allow_empty):
+        data = pixels.data
+        tile_size = (data.shape[-1] - 2 * buffer) // size
+
+        for (i, tile) in enumerate(tiles):
+            (row, col) = divmod(i, size)
+            tile_data = data[:, row * tile_size:(row + 1) * tile_size +
+                             2 * buffer, col * tile_size:(col + 1) *
+                             tile_size + 2 * buffer]
+            tile_pixels = PixelCollection(
+                tile_data, _buffered_bounds(tile, tile_data.shape[1:],
+                                            buffer))
+
+            for (index, result) in zip(indexes, encode_outputs(
+                    tile_pixels,
+                    buffer,
+                    [outputs[j] for j in indexes],
+                    scale,
+                    headers=headers)):
+                results[i][index] = result
+
+    return list(zip(tiles, results))
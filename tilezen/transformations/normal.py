@@ -37,7 +37,7 @@ def _generate_mapping_table():
 
 
 # Make a constant version of the table for reference.
-HEIGHT_TABLE = _generate_mapping_table()
+HEIGHT_TABLE = np.array(_generate_mapping_table())
 
 
 # Function which returns the index of the maximum height in the height table
@@ -49,9 +49,125 @@ def _height_mapping_func(h):
     return 255 - bisect.bisect_left(HEIGHT_TABLE, h)
 
 
+# Array equivalent of `_height_mapping_func`: `searchsorted` with side="left"
+# performs the same binary search as `bisect_left`, but for every pixel at
+# once.
+def _height_mapping(data):
+    return (255 - np.searchsorted(HEIGHT_TABLE, data, side="left")).astype(
+        np.uint8)
+
+
+def _gradient(data, out, axis, valid=None):
+    """
+    Equivalent of `np.gradient(data, 2)[axis]`, written into `out`.
+
+    If `valid` is provided, masked pixels aren't used: next to them, one-sided
+    differences are used (as at the edges), and pixels with no valid
+    neighbors along `axis` get 0.
+    """
+    data = np.swapaxes(data, 0, axis)
+    view = np.swapaxes(out, 0, axis)
+
+    # central differences in the interior, one-sided differences at the edges
+    np.subtract(data[2:], data[:-2], out=view[1:-1])
+    view[1:-1] *= 0.25
+    np.subtract(data[1], data[0], out=view[0])
+    np.subtract(data[-1], data[-2], out=view[-1])
+    view[[0, -1]] *= 0.5
+
+    if valid is not None:
+        valid = np.swapaxes(valid, 0, axis)
+        (before, after) = (valid[:-2], valid[2:])
+
+        np.copyto(
+            view[1:-1], (data[2:] - data[1:-1]) * 0.5,
+            where=after & ~before)
+        np.copyto(
+            view[1:-1], (data[1:-1] - data[:-2]) * 0.5,
+            where=before & ~after)
+        view[1:-1][~(before | after)] = 0
+        view[0][~valid[1]] = 0
+        view[-1][~valid[-2]] = 0
+
+    return out
+
+
+def _normal_map(data, dx, dy, dtype=np.float64):
+    """Encode an elevation array as an RGBA normal map.
+
+    Intermediate values are computed at `dtype` precision in a fixed set of
+    preallocated buffers and packed directly into the (H, W, 4) uint8
+    output. Masked pixels are excluded from gradients.
+    """
+    mask = np.ma.getmaskarray(data)
+    valid = ~mask if mask.any() else None
+    # gradients are taken at the data's precision (as np.gradient does)
+    # unless `dtype` is less precise
+    if (np.issubdtype(data.dtype, np.floating)
+            and data.dtype.itemsize < np.dtype(dtype).itemsize):
+        gradient_dtype = data.dtype
+    else:
+        gradient_dtype = dtype
+
+    # nodata values never contribute to gradients, but fill them so that
+    # masked pixels are deterministic
+    elevation = np.asarray(np.ma.filled(data, 0), dtype=gradient_dtype)
+    out = np.empty(elevation.shape + (4, ), dtype=np.uint8)
+
+    x = _gradient(elevation, np.empty_like(elevation), 1, valid)
+    y = _gradient(elevation, np.empty_like(elevation), 0, valid)
+    x *= -1.0 / dx
+    y *= 1.0 / dy
+    x = x.astype(dtype, copy=False)
+    y = y.astype(dtype, copy=False)
+
+    # normalise to unit vectors: (x, y, 1) / sqrt(x^2 + y^2 + 1). the
+    # components are then in the range (-1, 1), but we need values between 0
+    # and 255 for PNG channels, so we move and scale them to fit in that
+    # range: 128 * (c / norm + 1). operations are ordered as np.gradient and
+    # the original einsum-based implementation ordered them, so float64
+    # output is bit-for-bit the same.
+    norm = x * x
+    norm += y * y
+    norm += 1.0
+    np.sqrt(norm, out=norm)
+
+    for (band, component) in enumerate((x, y)):
+        component /= norm
+        component += 1.0
+        component *= 128.0
+        # clip to (0, 255) just in case
+        np.clip(component, 0.0, 255.0, out=component)
+        np.copyto(out[:, :, band], component, casting="unsafe")
+
+    # z is 1.0 everywhere, so its scaled value is 128 * (1 / norm + 1)
+    np.divide(1.0, norm, out=norm)
+    norm += 1.0
+    norm *= 128.0
+    np.clip(norm, 0.0, 255.0, out=norm)
+    np.copyto(out[:, :, 2], norm, casting="unsafe")
+
+    # apply the height mapping function to get the table index; use the
+    # original values, since casting can move them across bin edges
+    out[:, :, 3] = _height_mapping(np.ma.getdata(data))
+
+    # turn masked values transparent
+    if valid is not None:
+        out[:, :, 3][mask] = 0
+
+    return out
+
+
 class Normal(TransformationBase):
     buffer = 4
 
+    def __init__(self, collar=0, dtype=np.float64):
+        TransformationBase.__init__(self, collar=collar)
+        # float32 halves the size of intermediate buffers and keeps normals
+        # within +/-1 of the float64 output (hypsometric indexes are always
+        # computed from the original values)
+        self.dtype = dtype
+
     def transform(self, pixels):
         data, (bounds, crs), _ = pixels
         (count, height, width) = data.shape
@@ -62,38 +178,10 @@ class Normal(TransformationBase):
         (dx, dy) = get_resolution_in_meters(pixels.bounds, (height, width))
         data = apply_latitude_adjustments(pixels).data[0]
 
-        ygrad, xgrad = np.gradient(data, 2)
-        img = np.dstack((-1.0 / dx * xgrad, 1.0 / dy * ygrad,
-                         np.ones(data.shape)))
-
-        # first, we normalise to unit vectors. this puts each element of img
-        # in the range (-1, 1). the "einsum" stuff is serious black magic, but
-        # what it (should be) saying is "for each i,j in the rows and columns,
-        # the output is the sum of img[i,j,k]*img[i,j,k]" - i.e: the square.
-        norm = np.sqrt(np.einsum('ijk,ijk->ij', img, img))
-
-        # the norm is now the "wrong shape" according to numpy, so we need to
-        # copy the norm value out into RGB components.
-        norm_copy = norm[:, :, np.newaxis]
-
-        # dividing the img by norm_copy should give us RGB components with
-        # values between -1 and 1, but we need values between 0 and 255 for
-        # PNG channels. so we move and scale the values to fit in that range.
-        scaled = (128.0 * (img / norm_copy + 1.0))
-
-        # and finally clip it to (0, 255) just in case
-        img = np.clip(scaled, 0.0, 255.0).astype(np.uint8)
-
-        # apply the height mapping function to get the table index.
-        func = np.vectorize(_height_mapping_func)
-        hyps = func(data).astype(np.uint8)
-
-        # turn masked values transparent
-        if data.mask.any():
-            hyps[data.mask] = 0
-
         # Create output as a 4-channel RGBA image, each (byte) channel
         # corresponds to x, y, z, h where x, y and z are the respective
         # components of the normal, and h is an index into a hypsometric tint
         # table (see HEIGHT_TABLE).
-        return PixelCollection(np.dstack((img, hyps)), pixels.bounds), "RGBA"
+        img = _normal_map(data, dx, dy, dtype=self.dtype)
+
+        return PixelCollection(img, pixels.bounds), "RGBA"
@@ -0,0 +1,111 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from rasterio.warp import Resampling
+
+# (source size, target size, resampling) -> taps
+_TAPS = {}
+
+
+def _taps(src, dst, resampling):
+    """
+    Calculate (and cache) the source indices and weights needed to resize one
+    axis from `src` to `dst` pixels, with pixel centers aligned.
+    """
+    key = (src, dst, resampling)
+
+    if key not in _TAPS:
+        centers = (np.arange(dst) + 0.5) * (src / dst)
+
+        if resampling == Resampling.nearest:
+            taps = np.minimum(centers.astype(np.intp), src - 1)
+        elif resampling == Resampling.bilinear:
+            x = np.clip(centers - 0.5, 0, src - 1)
+            lo = np.floor(x).astype(np.intp)
+            hi = np.minimum(lo + 1, src - 1)
+            weights = (x - lo).astype(np.float32)
+            taps = (lo, hi, 1 - weights, weights)
+        else:
+            raise Exception(
+                "Unsupported resampling method: {}".format(resampling))
+
+        _TAPS[key] = taps
+
+    return _TAPS[key]
+
+
+def resize(data, shape, resampling=Resampling.bilinear):
+    """
+    Resize a 2d array to `shape`.
+
+    This is equivalent to a same-CRS `warp.reproject` between 2 affine
+    transforms covering the same bounds, but avoids GDAL's warper setup. Each
+    axis is resampled separately; only the 2 nearest source pixels contribute
+    to each target pixel, so nodata (including NaN) doesn't spread.
+
+    Nearest-neighbor resizing preserves `data`'s dtype; bilinear resizing
+    produces floats.
+    """
+    (height, width) = shape
+    (src_height, src_width) = data.shape
+
+    if resampling == Resampling.nearest:
+        rows = _taps(src_height, height, resampling)
+        cols = _taps(src_width, width, resampling)
+
+        return data[rows[:, np.newaxis], cols]
+
+    (lo, hi, lo_weights, hi_weights) = _taps(src_height, height, resampling)
+    data = (data[lo] * lo_weights[:, np.newaxis] +
+            data[hi] * hi_weights[:, np.newaxis])
+
+    (lo, hi, lo_weights, hi_weights) = _taps(src_width, width, resampling)
+
+    return data[:, lo] * lo_weights + data[:, hi] * hi_weights
+
+
+def resize_masked(data, shape):
+    """
+    Bilinearly resize a 2d masked array to `shape` without letting masked
+    pixels contribute: values are weighted by validity and normalized by the
+    resized weights. Pixels with no valid contributors are masked.
+    """
+    mask = np.ma.getmaskarray(data)
+
+    if not mask.any():
+        return np.ma.masked_array(resize(np.ma.getdata(data), shape))
+
+    weights = resize((~mask).astype(np.float32), shape)
+    values = resize(np.ma.filled(data, 0), shape)
+    covered = weights > 0
+    np.divide(values, weights, out=values, where=covered)
+
+    return np.ma.masked_array(values, mask=~covered)
+
+
+def downsample(data, factor, resampling=Resampling.average):
+    """
+    Downsample a (count, height, width) masked array by an integer factor,
+    either by averaging each `factor` x `factor` block of pixels (blocks are
+    only masked when all of their pixels are) or by picking the top-left pixel
+    of each.
+    """
+    (count, height, width) = data.shape
+
+    if height % factor or width % factor:
+        raise Exception("Can't downsample {}x{} by a factor of {}".format(
+            width, height, factor))
+
+    if resampling == Resampling.nearest:
+        return data[:, ::factor, ::factor]
+
+    if resampling != Resampling.average:
+        raise Exception(
+            "Unsupported resampling method: {}".format(resampling))
+
+    blocks = np.ma.asarray(data).reshape(count, height // factor, factor,
+                                         width // factor, factor)
+
+    return blocks.mean(axis=(2, 4)).astype(data.dtype)
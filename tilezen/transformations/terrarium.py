@@ -5,9 +5,13 @@ import numpy as np
 
 from marblecutter import PixelCollection
 from marblecutter.transformations.utils import TransformationBase
+from rasterio.io import MemoryFile
 
 
 class Terrarium(TransformationBase):
+    # constant elevations encode the same way everywhere
+    position_independent = True
+
     def transform(self, pixels):
         data, bounds, _ = pixels
         (count, height, width) = data.shape
@@ -24,14 +28,60 @@ class Terrarium(TransformationBase):
         # is lower than any depth on Earth.
 
         pixels = data[0]
-        pixels.fill_value = 0
+        out = np.empty((height, width, 3), dtype=np.uint8)
+
+        # transform to uheight (in a new array, leaving the input untouched),
+        # clamping the range
+        uheight = np.add(np.ma.getdata(pixels), 32768.0)
+        np.clip(uheight, 0.0, 65535.0, out=uheight)
+
+        # split into integer and fractional parts; both are exact, so this
+        # matches dividing / taking the modulus of the float values
+        whole = uheight.astype(np.uint16)
+        np.right_shift(whole, 8, out=out[:, :, 0], casting="unsafe")
+        np.bitwise_and(whole, 0xFF, out=out[:, :, 1], casting="unsafe")
+
+        uheight -= whole
+        uheight *= 256
+        np.copyto(out[:, :, 2], uheight, casting="unsafe")
+
+        mask = np.ma.getmaskarray(pixels)
+        if mask.any():
+            out[mask] = 0
+
+        return PixelCollection(out, bounds), 'RGB'
+
+
+def decode(rgb):
+    """Decode an (H, W, 3) terrarium-encoded array into float32 elevations.
+
+    Pixels with R=0 (nodata, see `Terrarium`) are masked. (H, W, 4) arrays
+    are accepted too; pixels with alpha=0 are also masked.
+    """
+    if rgb.ndim != 3 or rgb.shape[2] not in (3, 4):
+        raise Exception(
+            "Can't decode heights from {} array".format(rgb.shape))
+
+    r, g, b = (rgb[:, :, band] for band in range(3))
+    mask = r == 0
+
+    if rgb.shape[2] == 4:
+        mask |= rgb[:, :, 3] == 0
+
+    # 8 bits of fraction + 16 bits of integer fit float32's significand, so
+    # this is exact
+    elevation = r.astype(np.float32)
+    elevation *= 256
+    elevation += g
+    elevation += b / np.float32(256)
+    elevation -= 32768
+
+    return np.ma.masked_array(elevation, mask=mask)
 
-        # transform to uheight, clamping the range
-        pixels += 32768.0
-        np.clip(pixels, 0.0, 65535.0, out=pixels)
 
-        r = (pixels / 256).astype(np.uint8)
-        g = (pixels % 256).astype(np.uint8)
-        b = ((pixels * 256) % 256).astype(np.uint8)
+def read(data):
+    """Decode a terrarium-encoded PNG (as bytes) into float32 elevations."""
+    with MemoryFile(data) as memfile, memfile.open() as dataset:
+        rgb = np.dstack(dataset.read())
 
-        return PixelCollection(np.dstack((r, g, b)), bounds), 'RGB'
+    return decode(rgb)
@@ -2,28 +2,95 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import threading
 
+import numpy as np
+from cachetools import LRUCache
 from flask import jsonify, render_template, request, url_for
-from marblecutter import footprints, tiling
+from marblecutter import NoDataAvailable, footprints, tiling
 from marblecutter.catalogs.postgis import PostGISCatalog
 from marblecutter.formats.color_ramp import ColorRamp
-from marblecutter.formats.geotiff import GeoTIFF
 from marblecutter.formats.png import PNG
 from marblecutter.transformations import Image
 from marblecutter.web import app
 from mercantile import Tile
 
 from . import skadi
+from .catalogs import (CachingCatalog, PostGISFootprints, PrefetchingCatalog,
+                       SnapshotCatalog, TileIndexCatalog)
+from .formats import PNG as TerrainPNG
+from .formats import Skadi, geotiff
+from .tiling import (CONSTANT_HEADER, metatile_for, render_metatile,
+                      render_tile_outputs)
 from .transformations import Hillshade, Normal, Terrarium
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-ELEVATION_CATALOG = PostGISCatalog(table="dems")
-GEOTIFF_FORMAT = GeoTIFF(area_or_point="Point")
-HILLSHADE_GEOTIFF_FORMAT = GeoTIFF()
+# cache sources for this many seconds (0 to disable)
+CATALOG_CACHE_TTL = int(os.environ.get("CATALOG_CACHE_TTL", 300))
+# footprint snapshots (see examples/export_catalog_snapshot.py) to query in
+# place of PostGIS
+ELEVATION_CATALOG_SNAPSHOT = os.environ.get("ELEVATION_CATALOG_SNAPSHOT")
+IMAGERY_CATALOG_SNAPSHOT = os.environ.get("IMAGERY_CATALOG_SNAPSHOT")
+
+if ELEVATION_CATALOG_SNAPSHOT:
+    ELEVATION_CATALOG = SnapshotCatalog(ELEVATION_CATALOG_SNAPSHOT)
+else:
+    ELEVATION_CATALOG = PostGISCatalog(table="dems")
+
+GEOTIFF_FORMAT = geotiff.from_env(area_or_point="Point")
+HILLSHADE_GEOTIFF_FORMAT = geotiff.from_env("HILLSHADE_GEOTIFF")
 HILLSHADE_TRANSFORMATION = Hillshade(resample=True, add_slopeshade=True)
-IMAGERY_CATALOG = PostGISCatalog(table="imagery")
+
+if IMAGERY_CATALOG_SNAPSHOT:
+    IMAGERY_CATALOG = SnapshotCatalog(IMAGERY_CATALOG_SNAPSHOT)
+else:
+    IMAGERY_CATALOG = PostGISCatalog(table="imagery")
+
+# answer source lookups from footprints prefetched for ancestors this many
+# zooms up (0 to disable)
+CATALOG_PREFETCH_LEVELS = int(os.environ.get("CATALOG_PREFETCH_LEVELS", 0))
+
+if CATALOG_PREFETCH_LEVELS > 0:
+    ELEVATION_CATALOG = PrefetchingCatalog(
+        ELEVATION_CATALOG,
+        PostGISFootprints(table="dems"),
+        levels=CATALOG_PREFETCH_LEVELS)
+    IMAGERY_CATALOG = PrefetchingCatalog(
+        IMAGERY_CATALOG,
+        PostGISFootprints(table="imagery"),
+        levels=CATALOG_PREFETCH_LEVELS)
+
+# serve sources for tiles at low and mid zooms from materialized indexes (see
+# examples/build_tile_index.py)
+if os.environ.get("ELEVATION_TILE_INDEX"):
+    ELEVATION_CATALOG = TileIndexCatalog(
+        os.environ["ELEVATION_TILE_INDEX"], ELEVATION_CATALOG)
+
+if os.environ.get("IMAGERY_TILE_INDEX"):
+    IMAGERY_CATALOG = TileIndexCatalog(os.environ["IMAGERY_TILE_INDEX"],
+                                       IMAGERY_CATALOG)
+
+if CATALOG_CACHE_TTL > 0:
+    ELEVATION_CATALOG = CachingCatalog(
+        ELEVATION_CATALOG, ttl=CATALOG_CACHE_TTL)
+    IMAGERY_CATALOG = CachingCatalog(IMAGERY_CATALOG, ttl=CATALOG_CACHE_TTL)
+
+# render NxN blocks of PNG tiles at once and hold onto their siblings
+METATILE_SIZE = int(os.environ.get("METATILE_SIZE", 1))
+METATILE_CACHE = LRUCache(int(os.environ.get("METATILE_CACHE_SIZE", 1024)))
+METATILE_LOCK = threading.Lock()
+# (renderer, metatile, scale) -> (lock held while rendering, waiting threads)
+METATILE_RENDERS = {}
+
+if METATILE_SIZE < 1 or METATILE_SIZE & (METATILE_SIZE - 1):
+    raise Exception("METATILE_SIZE must be a power of 2")
+
+SKADI_FORMAT = Skadi(
+    compresslevel=int(os.environ.get("SKADI_COMPRESSION_LEVEL", 9)),
+    threads=int(os.environ.get("SKADI_COMPRESSION_THREADS", 1)))
 
 CATALOGS = {
     "buffered_normal": ELEVATION_CATALOG,
@@ -34,16 +101,19 @@ CATALOGS = {
 }
 DATA_BAND_COUNTS = {"imagery": 3}
 FORMATS = {
-    "buffered_normal": PNG(),
+    "buffered_normal":
+    TerrainPNG(os.environ.get("BUFFERED_NORMAL_PNG_PROFILE", "balanced")),
     "hillshade": ColorRamp(),
     "imagery": PNG(),
-    "normal": PNG(),
-    "terrarium": PNG(),
+    "normal": TerrainPNG(os.environ.get("NORMAL_PNG_PROFILE", "balanced")),
+    "terrarium":
+    TerrainPNG(os.environ.get("TERRARIUM_PNG_PROFILE", "balanced")),
 }
 RENDERERS = ["hillshade", "imagery", "buffered_normal", "normal", "terrarium"]
 TRANSFORMATIONS = {
-    "buffered_normal": Normal(collar=2),
-    "hillshade": HILLSHADE_TRANSFORMATION,
+    "buffered_normal": Normal(collar=2, dtype=np.float32),
+    # hillshade tiles are rendered using a lookup table; GeoTIFFs are exact
+    "hillshade": Hillshade(resample=True, add_slopeshade=True, lut=True),
     "imagery": Image(),
     "normal": Normal(),
     "terrarium": Terrarium(),
@@ -61,6 +131,17 @@ def make_prefix():
         return request.headers.get("X-Stage")
 
 
+@app.route("/catalogs/stats.json")
+@app.route("/<prefix>/catalogs/stats.json")
+def catalog_stats(**kwargs):
+    return jsonify({
+        name: catalog.stats
+        for (name, catalog) in [("elevation", ELEVATION_CATALOG),
+                                ("imagery", IMAGERY_CATALOG)]
+        if isinstance(catalog, CachingCatalog)
+    })
+
+
 @app.route("/<renderer>/")
 @app.route("/<prefix>/<renderer>/")
 def meta(renderer, **kwargs):
@@ -125,18 +206,86 @@ def render_geotiff(z, x, y, **kwargs):
 @app.route("/<prefix>/<renderer>/<int:z>/<int:x>/<int:y>@<int:scale>x.png")
 def render_png(renderer, z, x, y, scale=1, **kwargs):
     tile = Tile(x, y, z)
+    transformation = TRANSFORMATIONS.get(renderer)
 
-    headers, data = tiling.render_tile(
-        tile,
-        CATALOGS[renderer],
-        format=FORMATS[renderer],
-        transformation=TRANSFORMATIONS.get(renderer),
-        scale=scale,
-        data_band_count=DATA_BAND_COUNTS.get(renderer, 1))
+    if getattr(transformation, "collar", 0):
+        headers, data = tiling.render_tile(
+            tile,
+            CATALOGS[renderer],
+            format=FORMATS[renderer],
+            transformation=transformation,
+            scale=scale,
+            data_band_count=DATA_BAND_COUNTS.get(renderer, 1))
+    elif METATILE_SIZE > 1:
+        headers, data = render_png_from_metatile(renderer, tile, scale)
+    else:
+        # constant tiles are served from a cache; tiles without sources are
+        # still 404s
+        [(headers, data)] = render_tile_outputs(
+            tile,
+            CATALOGS[renderer],
+            [(transformation, FORMATS[renderer], scale)],
+            data_band_count=DATA_BAND_COUNTS.get(renderer, 1),
+            allow_empty=False)
 
     return data, 200, headers
 
 
+def _sibling_output(output):
+    """
+    Tiles cut from a metatile that have no data are 404s, like tiles rendered
+    on their own.
+    """
+    (headers, _) = output
+
+    if headers.get(CONSTANT_HEADER) == "masked":
+        raise NoDataAvailable()
+
+    return output
+
+
+def render_png_from_metatile(renderer, tile, scale):
+    key = (renderer, tile, scale)
+    meta, size = metatile_for(tile, METATILE_SIZE)
+    render_key = (renderer, meta, scale)
+
+    with METATILE_LOCK:
+        if key in METATILE_CACHE:
+            return _sibling_output(METATILE_CACHE.get(key))
+
+        # render each metatile once; concurrent requests for its tiles wait
+        # for that render rather than starting their own
+        (lock, waiting) = METATILE_RENDERS.get(render_key,
+                                               (threading.Lock(), 0))
+        METATILE_RENDERS[render_key] = (lock, waiting + 1)
+
+    try:
+        with lock:
+            with METATILE_LOCK:
+                if key in METATILE_CACHE:
+                    return _sibling_output(METATILE_CACHE.get(key))
+
+            results = render_metatile(
+                meta,
+                CATALOGS[renderer],
+                [(TRANSFORMATIONS.get(renderer), FORMATS[renderer], scale)],
+                size,
+                data_band_count=DATA_BAND_COUNTS.get(renderer, 1),
+                allow_empty=False)
+
+            with METATILE_LOCK:
+                for (sibling, [output]) in results:
+                    METATILE_CACHE[(renderer, sibling, scale)] = output
+
+        return _sibling_output(dict(results)[tile][0])
+    finally:
+        with METATILE_LOCK:
+            (lock, waiting) = METATILE_RENDERS.pop(render_key)
+
+            if waiting > 1:
+                METATILE_RENDERS[render_key] = (lock, waiting - 1)
+
+
 @app.route("/<renderer>/<int:z>/<int:x>/<int:y>.geojson")
 @app.route("/<renderer>/<int:z>-<int:max_zoom>/<int:x>/<int:y>.geojson")
 @app.route("/<renderer>/<int:z>/<int:x>/<int:y>@<int:scale>x.geojson")
@@ -225,6 +374,7 @@ def render_hillshade_tiff(z, x, y, **kwargs):
 @app.route("/skadi/<_>/<tile>.hgt.gz")
 @app.route("/<prefix>/skadi/<_>/<tile>.hgt.gz")
 def render_skadi(_, tile, **kwargs):
-    headers, data = skadi.render_tile(tile)
+    headers, data = skadi.render_tile(
+        tile, ELEVATION_CATALOG, format=SKADI_FORMAT)
 
     return data, 200, headers